@@ -30,10 +30,10 @@ from mercurial.i18n import _
 
 demandimport.ignore.extend([
     'collections',
+    'multiprocessing',
     ])
 
 import gitrepo, hgrepo
-from git_handler import GitHandler
 
 # support for `hg clone git://github.com/defunkt/facebox.git`
 # also hg clone git+ssh://git@github.com/schacon/simplegit.git
@@ -92,26 +92,48 @@ def reposetup(ui, repo):
         repo.__class__ = klass
 
 def gimport(ui, repo, remote_name=None):
-    git = GitHandler(repo, ui)
+    git = repo.githandler
     git.import_commits(remote_name)
 
 def gexport(ui, repo):
-    git = GitHandler(repo, ui)
+    git = repo.githandler
     git.export_commits()
 
 def gclear(ui, repo):
     repo.ui.status(_("clearing out the git cache data\n"))
-    git = GitHandler(repo, ui)
+    git = repo.githandler
     git.clear()
 
+def _isgitpath(path):
+    for scheme in ('git', 'git+ssh'):
+        if path.startswith('%s://' % scheme):
+            return True
+    return _local(path) is gitrepo
+
+def gfetchall(ui, repo, *remotes, **opts):
+    """fetch from several git remotes at once
+
+    Without arguments, every path in [paths] that points at a git
+    repository is fetched. Packs are downloaded from up to --jobs remotes
+    at the same time and imported one remote at a time afterwards.
+    """
+    if remotes:
+        paths = [ui.expandpath(remote) for remote in remotes]
+    else:
+        paths = [path for name, path in sorted(ui.configitems('paths'))
+                 if _isgitpath(path)]
+    if not paths:
+        raise hgutil.Abort(_('no git remotes to fetch from'))
+    jobs = opts.get('jobs') or ui.configint('git', 'fetchjobs', 4)
+    git = repo.githandler
+    if git.fetch_all(paths, int(jobs)):
+        return 1
+
 def git_cleanup(ui, repo):
-    new_map = []
-    for line in repo.opener(GitHandler.mapfile):
-        gitsha, hgsha = line.strip().split(' ', 1)
-        if hgsha in repo:
-            new_map.append('%s %s\n' % (gitsha, hgsha))
-    f = repo.opener(GitHandler.mapfile, 'wb')
-    map(f.write, new_map)
+    git = repo.githandler
+    new_map = [(gitsha, hgsha) for gitsha, hgsha in git._map.iteritems()
+               if hgsha in repo]
+    git._map.rewrite(new_map)
     ui.status(_('git commit map cleaned\n'))
 
 # drop this when we're 1.6-only, this just backports new behavior
@@ -140,7 +162,7 @@ try:
             kw.update(kwargs)
             for val, k in zip(args, ('base', kwname, 'force')):
                 kw[k] = val
-            git = GitHandler(local, local.ui)
+            git = local.githandler
             base, heads = git.get_refs(remote.path)
             newkw = {'base': base, kwname: heads}
             newkw.update(kw)
@@ -166,7 +188,7 @@ def getremotechanges(orig, ui, repo, other, *args, **opts):
             revs = args[0]
         else:
             revs = opts.get('onlyheads', opts.get('revs'))
-        git = GitHandler(repo, ui)
+        git = repo.githandler
         r, c, cleanup = git.getremotechanges(other, revs)
         # ugh. This is ugly even by mercurial API compatibility standards
         if 'onlyheads' not in orig.func_code.co_varnames:
@@ -179,6 +201,30 @@ except AttributeError:
     # 1.7+
     pass
 
+def _setdepth(ui, opts):
+    if opts.get('depth'):
+        ui.setconfig('git', 'depth', opts['depth'])
+    if opts.get('shallow_since'):
+        # the server wants a unix time
+        when = hgutil.parsedate(opts['shallow_since'])[0]
+        ui.setconfig('git', 'shallowsince', str(int(when)))
+
+def shallowpull(orig, ui, repo, *args, **opts):
+    _setdepth(ui, opts)
+    _setdepth(repo.ui, opts)
+    return orig(ui, repo, *args, **opts)
+
+def shallowclone(orig, ui, *args, **opts):
+    _setdepth(ui, opts)
+    return orig(ui, *args, **opts)
+
+for cmd, wrapper in (('pull', shallowpull), ('clone', shallowclone)):
+    entry = extensions.wrapcommand(commands.table, cmd, wrapper)
+    entry[1].append(('', 'depth', '',
+                     _('only fetch this many commits of git history')))
+    entry[1].append(('', 'shallow-since', '',
+                     _('only fetch git history newer than this date')))
+
 cmdtable = {
   "gimport":
         (gimport, [], _('hg gimport')),
@@ -186,6 +232,10 @@ cmdtable = {
         (gexport, [], _('hg gexport')),
   "gclear":
       (gclear, [], _('Clears out the Git cached data')),
+  "gfetchall":
+      (gfetchall,
+       [('j', 'jobs', '', _('number of remotes to fetch from at once'))],
+       _('hg gfetchall [-j JOBS] [REMOTE]...')),
   "git-cleanup": (git_cleanup, [], _(
         "Cleans up git repository after history editing"))
 }
@@ -1,9 +1,45 @@
+import os
+import stat
+import tempfile
+
 from mercurial import util
 
 class SSHVendor(object):
     """Parent class for ui-linked Vendor classes."""
 
 
+def controlpath():
+    """path for OpenSSH control sockets, in a directory only we can use"""
+    d = os.path.join(tempfile.gettempdir(), 'hggit-ssh-%d' % os.getuid())
+    try:
+        os.mkdir(d, 0700)
+    except OSError:
+        pass
+    st = os.lstat(d)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid()
+        or stat.S_IMODE(st.st_mode) != 0700):
+        return None
+    return os.path.join(d, '%r@%h:%p')
+
+def sharingargs(ui, sshcmd):
+    """OpenSSH options that let later connections reuse the first one
+
+    Discovery and the following transfer each open a connection. With
+    git.sshpersist set, the authenticated session is kept alive for that
+    many seconds so that the second one skips the handshake. Off by
+    default, and left alone if ui.ssh sets up sharing itself.
+    """
+    persist = ui.configint('git', 'sshpersist', 0)
+    if (not persist or os.name != 'posix' or
+        os.path.basename(sshcmd.split()[0]) != 'ssh' or
+        'Control' in sshcmd or ' -S' in sshcmd):
+        return ''
+    path = controlpath()
+    if path is None:
+        return ''
+    return ('-o ControlMaster=auto -o %s -o ControlPersist=%d' %
+            (util.shellquote('ControlPath=' + path), persist))
+
 def generate_ssh_vendor(ui):
     """
     Allows dulwich to use hg's ui.ssh config. The dulwich.client.get_ssh_vendor
@@ -18,6 +54,9 @@ def generate_ssh_vendor(ui):
 
             sshcmd = ui.config("ui", "ssh", "ssh")
             args = util.sshargs(sshcmd, host, username, port)
+            sharing = sharingargs(ui, sshcmd)
+            if sharing:
+                args = sharing + ' ' + args
             cmd = '%s %s %s' % (sshcmd, args, 
                                 util.shellquote(' '.join(command)))
             ui.debug('calling ssh: %s\n' % cmd)
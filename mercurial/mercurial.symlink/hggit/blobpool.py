@@ -0,0 +1,154 @@
+# hash and compress file contents into git blobs in worker processes
+#
+# Reading file revisions has to happen in the hg process, but computing
+# the sha1, deltas and deflating each blob is independent per blob, so it
+# is handed to a multiprocessing pool.
+
+import difflib
+import hashlib
+import multiprocessing
+import os
+import zlib
+
+# don't try to delta blobs larger than this, create_delta is slow
+MAXDELTASIZE = 512 * 1024
+# longest copy a single delta instruction can express
+MAXCOPY = 0xffff
+
+def _blobsha(data):
+    raw = 'blob %d\0' % len(data) + data
+    return hashlib.sha1(raw).hexdigest(), raw
+
+def _writeblob(job):
+    objectsdir, data = job
+    sha, raw = _blobsha(data)
+    dirpath = os.path.join(objectsdir, sha[:2])
+    path = os.path.join(dirpath, sha[2:])
+    if os.path.exists(path):
+        return sha
+    if not os.path.isdir(dirpath):
+        try:
+            os.mkdir(dirpath)
+        except OSError:
+            # another worker created it first
+            if not os.path.isdir(dirpath):
+                raise
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    f = open(tmppath, 'wb')
+    try:
+        f.write(zlib.compress(raw))
+    finally:
+        f.close()
+    os.rename(tmppath, path)
+    return sha
+
+def _deltasize(size):
+    ret = []
+    c = size & 0x7f
+    size >>= 7
+    while size:
+        ret.append(chr(c | 0x80))
+        c = size & 0x7f
+        size >>= 7
+    ret.append(chr(c))
+    return ''.join(ret)
+
+def _copyop(start, length):
+    op = 0x80
+    args = []
+    for i in range(4):
+        byte = (start >> (i * 8)) & 0xff
+        if byte:
+            op |= 1 << i
+            args.append(chr(byte))
+    for i in range(2):
+        byte = (length >> (i * 8)) & 0xff
+        if byte:
+            op |= 1 << (4 + i)
+            args.append(chr(byte))
+    return chr(op) + ''.join(args)
+
+def create_delta(base, target):
+    """a git delta turning base into target, computed line by line
+
+    dulwich's create_delta matches single bytes with difflib's autojunk
+    heuristic, which finds next to nothing in large text files.
+    """
+    baselines = base.splitlines(True)
+    targetlines = target.splitlines(True)
+    offsets = [0]
+    for line in baselines:
+        offsets.append(offsets[-1] + len(line))
+    out = [_deltasize(len(base)), _deltasize(len(target))]
+    matcher = difflib.SequenceMatcher(None, baselines, targetlines, False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            start, end = offsets[i1], offsets[i2]
+            while start < end:
+                length = min(end - start, MAXCOPY)
+                out.append(_copyop(start, length))
+                start += length
+        elif tag in ('replace', 'insert'):
+            data = ''.join(targetlines[j1:j2])
+            for i in xrange(0, len(data), 127):
+                chunk = data[i:i + 127]
+                out.append(chr(len(chunk)) + chunk)
+    return ''.join(out)
+
+def _packblob(job):
+    data, basedata = job
+    sha, raw = _blobsha(data)
+    if (basedata is not None and len(data) < MAXDELTASIZE
+        and len(basedata) < MAXDELTASIZE):
+        delta = create_delta(basedata, data)
+        if len(delta) < len(data) // 2:
+            return sha, True, len(delta), zlib.compress(delta)
+    return sha, False, len(data), zlib.compress(data)
+
+def defaultworkers():
+    # spawned workers on Windows cannot import the extension reliably
+    if os.name == 'nt':
+        return 1
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+class blobpool(object):
+    """convert file contents to git blobs using worker processes
+
+    With fewer than two workers the work is done in-process.
+    """
+    def __init__(self, workers):
+        self.pool = None
+        if workers > 1:
+            self.pool = multiprocessing.Pool(workers)
+
+    def _map(self, func, jobs):
+        # returns a callable that waits for the results
+        if self.pool is None:
+            results = map(func, jobs)
+            return lambda: results
+        return self.pool.map_async(func, jobs).get
+
+    def write(self, objectsdir, datas):
+        """start writing a batch of loose blob objects to objectsdir
+
+        The returned callable waits for the batch and gives the blob shas
+        in the same order as datas.
+        """
+        return self._map(_writeblob, [(objectsdir, data) for data in datas])
+
+    def pack(self, jobs):
+        """start deflating a batch of (data, basedata) blobs for a pack
+
+        The returned callable waits for the batch and gives a
+        (sha, isdelta, size, zdata) tuple for each job. If isdelta is
+        set, zdata is the deflated delta against basedata.
+        """
+        return self._map(_packblob, jobs)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
@@ -0,0 +1,228 @@
+# persistent cache of git commit parents, dates and trees
+#
+# hggit-commitgraph in the git directory holds one fixed-width record per
+# commit, appended in topological order: commit sha, tree sha, commit date
+# and the positions of the first two parents. The remaining parents of
+# octopus merges are listed in hggit-commitgraph-edges. The sorted
+# hggit-commitgraph-lookup file maps commit shas to record positions and
+# is searched by bisection.
+
+import mmap
+import os
+import struct
+
+from mercurial import util as hgutil
+from mercurial.node import bin, hex
+
+RECORD = struct.Struct('>20s20sqLL')
+LOOKUP = struct.Struct('>20sL')
+EDGE = struct.Struct('>L')
+
+NOPARENT = 0xffffffff
+# set on the second parent field when the parents continue in the edges
+# file, and on the last parent listed there
+EXTRAEDGES = 0x80000000
+
+def _closefile(f):
+    # If this complains that NoneType is not callable, then
+    # atomictempfile no longer has either of rename (pre-1.9) or
+    # close (post-1.9)
+    getattr(f, 'rename', getattr(f, 'close', None))()
+
+class _mappedfile(object):
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._data = None
+
+    def data(self):
+        if self._data is None:
+            if os.path.exists(self.path) and os.path.getsize(self.path):
+                self._file = open(self.path, 'rb')
+                self._data = mmap.mmap(self._file.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            else:
+                self._data = ''
+        return self._data
+
+    def close(self):
+        if self._file is not None:
+            self._data.close()
+            self._file.close()
+        self._file = None
+        self._data = None
+
+class commitgraph(object):
+    """parents, commit date and tree of git commits, by sha
+
+    Commits are added with extend(), which also adds any ancestors that
+    are missing so that parents can be stored as record positions.
+    """
+    def __init__(self, gitdir):
+        self.base = os.path.join(gitdir, 'hggit-commitgraph')
+        self._records = _mappedfile(self.base)
+        self._edges = _mappedfile(self.base + '-edges')
+        self._lookup = _mappedfile(self.base + '-lookup')
+        # commits added since the last write
+        self._new = []
+        self._newpos = {}
+        self._newedges = []
+        self._count = None
+
+    def _oldcount(self):
+        # records beyond the lookup file come from an interrupted write
+        # and are overwritten by the next one
+        if self._count is None:
+            self._count = len(self._lookup.data()) // LOOKUP.size
+        return self._count
+
+    def __len__(self):
+        return self._oldcount() + len(self._new)
+
+    def _position(self, sha):
+        pos = self._newpos.get(sha)
+        if pos is not None:
+            return pos
+        data = self._lookup.data()
+        lo, hi = 0, self._oldcount()
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key, pos = LOOKUP.unpack_from(data, mid * LOOKUP.size)
+            if key < sha:
+                lo = mid + 1
+            elif key > sha:
+                hi = mid
+            else:
+                return pos
+        return None
+
+    def __contains__(self, sha):
+        return self._position(bin(sha)) is not None
+
+    def _record(self, pos):
+        old = self._oldcount()
+        if pos >= old:
+            return self._new[pos - old]
+        return RECORD.unpack_from(self._records.data(), pos * RECORD.size)
+
+    def _edge(self, index):
+        old = len(self._edges.data()) // EDGE.size
+        if index >= old:
+            return self._newedges[index - old]
+        return EDGE.unpack_from(self._edges.data(), index * EDGE.size)[0]
+
+    def info(self, sha):
+        """(parents, commit date, tree) of a commit, or None"""
+        pos = self._position(bin(sha))
+        if pos is None:
+            return None
+        sha, tree, date, p1, p2 = self._record(pos)
+        parents = []
+        if p1 != NOPARENT:
+            parents.append(p1)
+        if p2 & EXTRAEDGES and p2 != NOPARENT:
+            index = p2 & ~EXTRAEDGES
+            while True:
+                edge = self._edge(index)
+                parents.append(edge & ~EXTRAEDGES)
+                if edge & EXTRAEDGES:
+                    break
+                index += 1
+        elif p2 != NOPARENT:
+            parents.append(p2)
+        parents = tuple(hex(self._record(p)[0]) for p in parents)
+        return parents, date, hex(tree)
+
+    def extend(self, shas, getobject, grafts=()):
+        """add commits and their missing ancestors
+
+        Commits in grafts are added without parents.
+        """
+        parsed = {}
+        for sha in shas:
+            todo = [sha]
+            while todo:
+                sha = todo[-1]
+                if sha in self:
+                    todo.pop()
+                    continue
+                info = parsed.get(sha)
+                if info is None:
+                    commit = getobject(sha)
+                    parents = commit.parents
+                    if sha in grafts:
+                        parents = []
+                    info = parsed[sha] = (
+                        parents, commit.tree,
+                        commit.commit_time - commit.commit_timezone)
+                missing = [p for p in info[0] if p not in self]
+                if missing:
+                    todo.extend(missing)
+                    continue
+                self._add(sha, *info)
+                del parsed[sha]
+                todo.pop()
+
+    def _add(self, sha, parents, tree, date):
+        positions = [self._position(bin(p)) for p in parents]
+        p1 = p2 = NOPARENT
+        if positions:
+            p1 = positions[0]
+        if len(positions) == 2:
+            p2 = positions[1]
+        elif len(positions) > 2:
+            p2 = EXTRAEDGES | (len(self._edges.data()) // EDGE.size +
+                               len(self._newedges))
+            self._newedges.extend(positions[1:-1])
+            self._newedges.append(positions[-1] | EXTRAEDGES)
+        self._newpos[bin(sha)] = len(self)
+        self._new.append((bin(sha), bin(tree), date, p1, p2))
+
+    def write(self):
+        if not self._new:
+            return
+        count = self._oldcount()
+        for mapped in (self._records, self._edges, self._lookup):
+            mapped.close()
+
+        f = open(self.base, 'ab')
+        try:
+            f.truncate(count * RECORD.size)
+            f.seek(count * RECORD.size)
+            for record in self._new:
+                f.write(RECORD.pack(*record))
+        finally:
+            f.close()
+        if self._newedges:
+            f = open(self.base + '-edges', 'ab')
+            try:
+                for edge in self._newedges:
+                    f.write(EDGE.pack(edge))
+            finally:
+                f.close()
+
+        # the lookup file is replaced last, it makes the new records valid
+        old = self._lookup.data()
+        new = sorted(self._newpos.iteritems())
+        f = hgutil.atomictempfile(self.base + '-lookup', 'wb')
+        i = j = 0
+        while i < count or j < len(new):
+            if j == len(new) or (i < count and
+                                 old[i * LOOKUP.size:i * LOOKUP.size + 20]
+                                 < new[j][0]):
+                f.write(old[i * LOOKUP.size:(i + 1) * LOOKUP.size])
+                i += 1
+            else:
+                f.write(LOOKUP.pack(*new[j]))
+                j += 1
+        self._lookup.close()
+        _closefile(f)
+
+        self._new = []
+        self._newpos = {}
+        self._newedges = []
+        self._count = None
+
+    def close(self):
+        for mapped in (self._records, self._edges, self._lookup):
+            mapped.close()
@@ -1,7 +1,9 @@
-import os, math, urllib, re
+import os, math, urllib, re, socket, stat, threading
+import fnmatch
 
 from dulwich.errors import HangupException, GitProtocolError
 from dulwich.index import commit_tree
+from dulwich.object_store import ObjectStoreGraphWalker
 from dulwich.objects import Blob, Commit, Tag, Tree, parse_timezone
 from dulwich.pack import create_delta, apply_delta
 from dulwich.repo import Repo
@@ -19,7 +21,13 @@ from mercurial import context, util as hgutil
 from mercurial import error
 
 import _ssh
+import protocolv2
+import sendpack
 import util
+from blobpool import blobpool, defaultworkers
+from commitgraph import commitgraph
+from packwriter import packwriter
+from gitmap import gitmap
 from overlay import overlayrepo
 
 class GitProgress(object):
@@ -65,6 +73,18 @@ class GitProgress(object):
 class GitHandler(object):
     mapfile = 'git-mapfile'
     tagsfile = 'git-tags'
+    exportmarkfile = 'git-export-mark'
+    # unexported revisions below the export mark that are listed one by
+    # one, with more the mark is lowered instead
+    maxexportexceptions = 1000
+    # bytes of file contents kept around as delta bases while exporting
+    maxdeltacache = 64 * 1024 * 1024
+    maxdeltadepth = 50
+    # trees kept parsed while exporting
+    maxtreecache = 10000
+    maxblobcache = 100000
+    # parsed trees, commits and tags kept by get_git_object
+    maxobjectcache = 10000
 
     def __init__(self, dest_repo, ui):
         self.repo = dest_repo
@@ -77,53 +97,179 @@ class GitHandler(object):
 
         self.paths = ui.configitems('paths')
 
-        self.load_map()
-        self.load_tags()
+        # the map, the tags and the git repository are loaded on first use
+        self._gitmap = None
+        self._tags = None
+        self._git = None
+        self._commitgraph = None
+        self._shallow = None
+        self._mapstat = None
+        self._tagsstat = None
+        # pack that exported objects go to, if any
+        self._exportstore = None
+        self._treecache = {}
+        # hg node -> tree sha of the changesets exported by this export
+        self._exportedtrees = {}
+        # git commit sha -> (parents, commit date)
+        self._commitinfo = {}
+        # recently resolved filenode -> blob sha
+        self._blobcache = util.lrucache(self.maxblobcache)
+        self._objectcache = util.lrucache(self.maxobjectcache)
+        # hits and misses of the object cache, shown with --debug
+        self._objectstats = [0, 0]
+        # parsed manifests and manifest comparisons for merge imports
+        self._manifestcache = util.lrucache(8)
+        self._divergentcache = util.lrucache(64)
+        # octopus-done node -> imploded parent nodes, during an export
+        self._octopuscache = {}
+        # serialises object store changes of concurrent fetches
+        self._packlock = threading.Lock()
 
     # make the git data directory
     def init_if_missing(self):
         if os.path.exists(self.gitdir):
-            self.git = Repo(self.gitdir)
+            self._git = Repo(self.gitdir)
         else:
             os.mkdir(self.gitdir)
-            self.git = Repo.init_bare(self.gitdir)
+            self._git = Repo.init_bare(self.gitdir)
+
+    @property
+    def git(self):
+        if self._git is None:
+            self.init_if_missing()
+        return self._git
+
+    @property
+    def commitgraph(self):
+        if self._commitgraph is None:
+            self._commitgraph = commitgraph(self.gitdir)
+        return self._commitgraph
+
+    @property
+    def shallow(self):
+        """commits whose parents were left out by a shallow fetch"""
+        if self._shallow is None:
+            self._shallow = set()
+            path = os.path.join(self.gitdir, 'shallow')
+            if os.path.exists(path):
+                f = open(path, 'rb')
+                try:
+                    self._shallow.update(l.strip() for l in f if l.strip())
+                finally:
+                    f.close()
+        return self._shallow
+
+    def update_shallow(self, new_shallow, new_unshallow):
+        """record the boundary a shallow fetch moved
+
+        Later fetches send it to the server.
+        """
+        shallow = set(self.shallow)
+        shallow.update(new_shallow or ())
+        shallow.difference_update(new_unshallow or ())
+        path = os.path.join(self.gitdir, 'shallow')
+        if shallow:
+            f = open(path + '.tmp', 'wb')
+            try:
+                f.write(''.join('%s\n' % sha for sha in sorted(shallow)))
+            finally:
+                f.close()
+            hgutil.rename(path + '.tmp', path)
+        elif os.path.exists(path):
+            os.unlink(path)
+        self._shallow = None
+
+    def graph_walker(self, local):
+        """a graph walker over local that stops at the shallow boundary
+
+        It offers the local branches and the remote branches of earlier
+        fetches, which are all commits the server may have.
+        """
+        shallow = set(self.shallow)
+        def get_parents(sha):
+            if sha in shallow:
+                return []
+            return local[sha].parents
+        heads = set()
+        for base in ('refs/heads', 'refs/remotes'):
+            heads.update(sha for sha in local.refs.as_dict(base).itervalues()
+                         if sha in local.object_store)
+        walker = ObjectStoreGraphWalker(heads, get_parents)
+        # dulwich's version 0 client sends these to the server
+        walker.shallow = shallow
+        return walker
+
+    @property
+    def _map(self):
+        if self._gitmap is None:
+            self.load_map()
+        return self._gitmap
+
+    @property
+    def tags(self):
+        if self._tags is None:
+            self.load_tags()
+        return self._tags
+
+    def _filestat(self, names):
+        stat = []
+        for name in names:
+            try:
+                st = os.stat(self.repo.join(name))
+                stat.append((st.st_mtime, st.st_size))
+            except OSError:
+                stat.append(None)
+        return stat
+
+    def refresh(self):
+        """forget the loaded map and tags if their files changed on disk"""
+        if (self._gitmap is not None and not self._gitmap.dirty() and
+            self._mapstat != self._filestat(self._gitmap.files())):
+            self._gitmap.close()
+            self._gitmap = None
+            self._blobcache.clear()
+        if (self._tags is not None and
+            self._tagsstat != self._filestat([self.tagsfile])):
+            self._tags = None
 
     ## FILE LOAD AND SAVE METHODS
 
     def map_set(self, gitsha, hgsha):
-        self._map_git[gitsha] = hgsha
-        self._map_hg[hgsha] = gitsha
+        self._map.set(gitsha, hgsha)
 
     def map_hg_get(self, gitsha):
-        return self._map_git.get(gitsha)
+        return self._map.gethg(gitsha)
 
     def map_git_get(self, hgsha):
-        return self._map_hg.get(hgsha)
+        return self._map.getgit(hgsha)
 
     def load_map(self):
-        self._map_git = {}
-        self._map_hg = {}
-        if os.path.exists(self.repo.join(self.mapfile)):
-            for line in self.repo.opener(self.mapfile):
-                gitsha, hgsha = line.strip().split(' ', 1)
-                self._map_git[gitsha] = hgsha
-                self._map_hg[hgsha] = gitsha
+        # the indexes are only mapped and searched on first lookup
+        self._gitmap = gitmap(self.repo, self.mapfile,
+                              self.ui.configint('git', 'mapjournalsize',
+                                                10000))
+        self._mapstat = self._filestat(self._gitmap.files())
+
+    def forget_map(self):
+        """drop unsaved map entries by reloading the map from disk"""
+        if self._gitmap is not None:
+            self._gitmap.close()
+            self._gitmap = None
+            self._blobcache.clear()
 
     def save_map(self):
-        file = self.repo.opener(self.mapfile, 'w+', atomictemp=True)
-        for hgsha, gitsha in sorted(self._map_hg.iteritems()):
-            file.write("%s %s\n" % (gitsha, hgsha))
-        # If this complains that NoneType is not callable, then
-        # atomictempfile no longer has either of rename (pre-1.9) or
-        # close (post-1.9)
-        getattr(file, 'rename', getattr(file, 'close', None))()
+        if self._gitmap is None:
+            return
+        self._gitmap.save()
+        self._mapstat = self._filestat(self._gitmap.files())
 
     def load_tags(self):
-        self.tags = {}
+        self._tags = {}
+        self._tagsstat = self._filestat([self.tagsfile])
         if os.path.exists(self.repo.join(self.tagsfile)):
             for line in self.repo.opener(self.tagsfile):
                 sha, name = line.strip().split(' ', 1)
-                self.tags[name] = sha
+                self._tags[name] = sha
 
     def save_tags(self):
         file = self.repo.opener(self.tagsfile, 'w+', atomictemp=True)
@@ -134,24 +280,109 @@ class GitHandler(object):
         # atomictempfile no longer has either of rename (pre-1.9) or
         # close (post-1.9)
         getattr(file, 'rename', getattr(file, 'close', None))()
+        self._tagsstat = self._filestat([self.tagsfile])
+
+    def load_export_mark(self):
+        """(first revision to look at, unexported revisions before it)
+
+        The mark records the tip revision at the last export along with
+        its node. If the node no longer matches, history was stripped or
+        rewritten and everything is looked at again.
+        """
+        try:
+            file = self.repo.opener(self.exportmarkfile)
+        except IOError:
+            return 0, []
+        try:
+            lines = file.read().splitlines()
+        finally:
+            file.close()
+        cl = self.repo.changelog
+        try:
+            rev, node = lines[0].split(' ', 1)
+            rev = int(rev)
+            if rev >= len(cl) or hex(cl.node(rev)) != node:
+                return 0, []
+            unexported = sorted(cl.rev(bin(n)) for n in lines[1:])
+        except (IndexError, ValueError, error.LookupError):
+            return 0, []
+        return rev + 1, unexported
+
+    def save_export_mark(self, unexported):
+        cl = self.repo.changelog
+        rev = len(cl) - 1
+        unexported = sorted(unexported)
+        if len(unexported) > self.maxexportexceptions:
+            rev = unexported[0] - 1
+            unexported = []
+        if rev < 0:
+            if os.path.exists(self.repo.join(self.exportmarkfile)):
+                os.unlink(self.repo.join(self.exportmarkfile))
+            return
+        file = self.repo.opener(self.exportmarkfile, 'w+', atomictemp=True)
+        file.write('%d %s\n' % (rev, hex(cl.node(rev))))
+        for r in unexported:
+            file.write(hex(cl.node(r)) + '\n')
+        getattr(file, 'rename', getattr(file, 'close', None))()
 
     ## END FILE LOAD AND SAVE METHODS
 
     ## COMMANDS METHODS
 
     def import_commits(self, remote_name):
-        self.import_git_objects(remote_name)
+        self.import_git_batch(remote_name)
         self.update_hg_bookmarks(self.git.get_refs())
         self.save_map()
 
     def fetch(self, remote, heads):
-        self.export_commits()
+        self.export_for_fetch()
         refs = self.fetch_pack(remote, heads)
+        return self.import_fetched(remote, refs)
+
+    def fetch_all(self, remotes, workers):
+        """fetch from several remotes at once and import what they sent
+
+        Up to workers remotes are negotiated with and downloaded from at
+        the same time. The import into hg happens afterwards, one remote
+        at a time. Returns the number of remotes that could not be
+        fetched.
+        """
+        self.export_for_fetch()
+        # the workers open their own views of the repository and add their
+        # packs to self.git, so it has to exist before they start
+        self.init_if_missing()
+        # setting up transports changes globals in dulwich, so do it here
+        transports = [self.get_transport_and_path(remote)
+                      for remote in remotes]
+        self.ui.status(_("fetching from %d remotes\n") % len(remotes))
+        def fetch((remote, transport)):
+            # dulwich's pack files are not safe to read from several
+            # threads, so every fetch walks its own view of the repository
+            local = Repo(self.gitdir)
+            try:
+                return self.fetch_pack(remote, None, transport, quiet=True,
+                                       local=local)
+            finally:
+                getattr(local, 'close', lambda: None)()
+        results = util.threadmap(fetch, zip(remotes, transports), workers)
+
+        failed = 0
+        for remote, (refs, exc) in zip(remotes, results):
+            if exc is not None:
+                self.ui.warn(_("error fetching %s: %s\n") % (remote, exc[1]))
+                failed += 1
+                continue
+            self.ui.status(_("importing from %s\n") % remote)
+            self.import_fetched(remote, refs)
+        return failed
+
+    def import_fetched(self, remote, refs):
+        """import the refs fetched from remote, returning the moved heads"""
         remote_name = self.remote_name(remote)
 
         oldrefs = self.git.get_refs()
         if refs:
-            self.import_git_objects(remote_name, refs)
+            self.import_git_batch(remote_name, refs)
             self.import_tags(refs)
             self.update_hg_bookmarks(refs)
             if remote_name:
@@ -181,17 +412,31 @@ class GitHandler(object):
 
         return len(modheads)
 
-    def export_commits(self):
+    def export_commits(self, revs=None):
         try:
-            self.export_git_objects()
+            self.export_git_objects(revs)
             self.export_hg_tags()
             self.update_references()
         finally:
             self.save_map()
 
+    def export_for_fetch(self):
+        """export before fetching, only if git.exportonpull is set
+
+        Fetch negotiation only offers commits the server could have, and
+        those were fetched or pushed before and are already in the git
+        repository. Changesets that only exist in hg would add nothing,
+        so by default they are left for the next push. The git branches
+        of bookmarks whose changesets are already mapped are still
+        updated, the graph walker starts from them.
+        """
+        if self.ui.configbool('git', 'exportonpull', False):
+            self.export_commits()
+        else:
+            self.update_references()
+
     def get_refs(self, remote):
         self.export_commits()
-        client, path = self.get_transport_and_path(remote)
         old_refs = {}
         new_refs = {}
         def changed(refs):
@@ -202,7 +447,19 @@ class GitHandler(object):
             return {}
 
         try:
-            client.send_pack(path, changed, None)
+            session = self.v2session(remote)
+            if session is not None:
+                # only heads and tags can be pushed to
+                try:
+                    refs = session.ls_refs(['refs/heads/', 'refs/tags/'])
+                finally:
+                    session.close()
+                if not refs:
+                    refs = {'capabilities^{}': '0' * 40}
+                changed(refs)
+            else:
+                client, path = self.get_transport_and_path(remote)
+                client.send_pack(path, changed, None)
 
             changed_refs = [ref for ref, sha in new_refs.iteritems()
                             if sha != old_refs.get(ref)]
@@ -218,7 +475,8 @@ class GitHandler(object):
             raise hgutil.Abort(_("git remote error: ") + str(e))
 
     def push(self, remote, revs, force):
-        self.export_commits()
+        # push -r and -B only need the pushed revisions and their ancestors
+        self.export_commits(revs)
         changed_refs = self.upload_pack(remote, revs, force)
         remote_name = self.remote_name(remote)
 
@@ -230,7 +488,17 @@ class GitHandler(object):
             self.update_remote_branches(remote_name, changed_refs)
 
     def clear(self):
-        mapfile = self.repo.join(self.mapfile)
+        self.forget_map()
+        self._tags = None
+        self._git = None
+        if self._commitgraph is not None:
+            self._commitgraph.close()
+            self._commitgraph = None
+        self._commitinfo.clear()
+        self._objectcache.clear()
+        self._shallow = None
+        self._manifestcache.clear()
+        self._divergentcache.clear()
         if os.path.exists(self.gitdir):
             for root, dirs, files in os.walk(self.gitdir, topdown=False):
                 for name in files:
@@ -238,12 +506,15 @@ class GitHandler(object):
                 for name in dirs:
                     os.rmdir(os.path.join(root, name))
             os.rmdir(self.gitdir)
-        if os.path.exists(mapfile):
-            os.remove(mapfile)
+        for name in (gitmap.filenames(self.mapfile) +
+                     [self.exportmarkfile]):
+            mapfile = self.repo.join(name)
+            if os.path.exists(mapfile):
+                os.remove(mapfile)
 
     # incoming support
     def getremotechanges(self, remote, revs):
-        self.export_commits()
+        self.export_for_fetch()
         refs = self.fetch_pack(remote.path, revs)
 
         # refs contains all remote refs. Prune to only those requested.
@@ -256,33 +527,168 @@ class GitHandler(object):
         else:
             reqrefs = refs
 
-        commits = [bin(c) for c in self.getnewgitcommits(reqrefs)[1]]
+        commits = [bin(c) for c in self.getnewgitcommits(reqrefs)]
 
         b = overlayrepo(self, commits, refs)
 
-        return (b, commits, lambda: None)
+        return (b, commits, self.debug_object_cache)
 
     ## CHANGESET CONVERSION METHODS
 
-    def export_git_objects(self):
+    def ancestor_revs(self, revs):
+        """revision numbers of revs and all their ancestors"""
+        revs = [self.repo[rev].rev() for rev in revs]
+        if getattr(self.repo, 'revs', None):
+            return set(self.repo.revs('::%ld', revs))
+        return set(self.repo.changelog.ancestors(*revs)).union(revs)
+
+    def export_git_objects(self, revs=None):
+        """export unmapped changesets, or only the ancestors of revs"""
         self.init_if_missing()
 
-        nodes = [self.repo.lookup(n) for n in self.repo]
-        export = [node for node in nodes if not hex(node) in self._map_hg]
+        # only revisions added since the last export, and the ones it
+        # left out, can be unexported
+        start, unexported = self.load_export_mark()
+        cl = self.repo.changelog
+        candidates = [rev for rev in unexported + range(start, len(cl))
+                      if not self.map_git_get(hex(cl.node(rev)))]
+        skipped = []
+        if revs:
+            wanted = self.ancestor_revs(revs)
+            skipped = [rev for rev in candidates if rev not in wanted]
+            candidates = [rev for rev in candidates if rev in wanted]
+        export = [cl.node(rev) for rev in candidates]
         total = len(export)
-        if total:
-            self.ui.status(_("exporting hg objects to git\n"))
-        for i, rev in enumerate(export):
-            util.progress(self.ui, 'exporting', i, total=total)
+        if not total:
+            if start < len(cl) or len(unexported) != len(skipped):
+                self.save_export_mark(skipped)
+            return
+        self.ui.status(_("exporting hg objects to git\n"))
+        if self.ui.configbool('git', 'exportpack', True):
+            self._exportstore = packwriter(self.git.object_store)
+        try:
+            self.export_blobs(export)
+            for i, rev in enumerate(export):
+                util.progress(self.ui, 'exporting', i, total=total)
+                ctx = self.repo.changectx(rev)
+                state = ctx.extra().get('hg-git', None)
+                if state == 'octopus':
+                    self.ui.debug("revision %d is a part "
+                                  "of octopus explosion\n" % ctx.rev())
+                    continue
+                self.export_hg_commit(rev)
+            util.progress(self.ui, 'exporting', None, total=total)
+        finally:
+            # the map is saved even if the export fails, so whatever made
+            # it into the pack has to be kept
+            if self._exportstore is not None:
+                self._exportstore.close()
+                self._exportstore = None
+            self._treecache.clear()
+            self._exportedtrees.clear()
+            self._octopuscache.clear()
+        # the map has to be on disk before the mark moves past the
+        # exported revisions
+        self.save_map()
+        self.save_export_mark(skipped)
+
+    def object_store(self):
+        """the object store exported objects should be added to"""
+        if self._exportstore is not None:
+            return self._exportstore
+        return self.git.object_store
+
+    def export_blobs(self, export):
+        """convert the file revisions of the changesets in export to blobs
+
+        The file revisions are read here and hashed and compressed by a
+        pool of worker processes; export_hg_commit then finds every blob
+        already in the map. When exporting into a pack, each blob is
+        deltified against the previous version of the same path.
+        """
+        packing = self._exportstore is not None
+        workers = self.ui.configint('git', 'exportworkers', defaultworkers())
+        if workers < 2 and not packing:
+            return
+
+        # collect the unmapped file revisions. A changeset whose parents
+        # were all scanned or exported before only adds the files it
+        # touches.
+        todo = []
+        seen = set()
+        scanned = set()
+        for rev in export:
             ctx = self.repo.changectx(rev)
-            state = ctx.extra().get('hg-git', None)
-            if state == 'octopus':
-                self.ui.debug("revision %d is a part "
-                              "of octopus explosion\n" % ctx.rev())
+            if ctx.extra().get('hg-git', None) == 'octopus':
                 continue
-            self.export_hg_commit(rev)
-        util.progress(self.ui, 'importing', None, total=total)
+            mf = ctx.manifest()
+            # octopus parts are never mapped, so look through them
+            if all(p.node() in scanned or self.map_git_get(p.hex())
+                   for p in self.get_git_parents(ctx)):
+                files = [f for f in ctx.files() if f in mf]
+            else:
+                files = mf.keys()
+            scanned.add(ctx.node())
+            for f in files:
+                fnode = mf[f]
+                if fnode in seen or self.map_blob_get(fnode):
+                    continue
+                seen.add(fnode)
+                todo.append((f, fnode))
+        if not todo:
+            return
 
+        # previous version of each path, for deltas
+        basedata = {}
+        basesize = [0]
+        basesha = {}
+        depth = {}
+        def readbatch(batch):
+            datas = [self.repo.file(f).read(fnode) for f, fnode in batch]
+            if not packing:
+                return pool.write(self.git.object_store.path, datas)
+            jobs = []
+            for (f, fnode), data in zip(batch, datas):
+                # keep delta chains short enough to read back quickly
+                base = basedata.get(f)
+                depth[f] = depth.get(f, 0) + 1
+                if base is None or depth[f] > self.maxdeltadepth:
+                    base = None
+                    depth[f] = 0
+                jobs.append((data, base))
+                basesize[0] += len(data) - len(basedata.get(f, ''))
+                basedata[f] = data
+                while basesize[0] > self.maxdeltacache:
+                    basesize[0] -= len(basedata.popitem()[1])
+            return pool.pack(jobs)
+
+        def storebatch(batch, results):
+            for (f, fnode), result in zip(batch, results):
+                if packing:
+                    sha, isdelta, size, zdata = result
+                    base = isdelta and basesha[f] or None
+                    self._exportstore.add_blob(sha, size, zdata, base)
+                    basesha[f] = sha
+                else:
+                    sha = result
+                self.map_blob_set(sha, fnode)
+
+        pool = blobpool(workers)
+        try:
+            # read the next batch while the workers handle the current one
+            batchsize = 64
+            pending = None
+            for start in xrange(0, len(todo), batchsize):
+                batch = todo[start:start + batchsize]
+                wait = readbatch(batch)
+                if pending:
+                    storebatch(pending[0], pending[1]())
+                    util.progress(self.ui, 'blobs', start, total=len(todo))
+                pending = (batch, wait)
+            storebatch(pending[0], pending[1]())
+            util.progress(self.ui, 'blobs', None, total=len(todo))
+        finally:
+            pool.close()
 
     # convert this commit into git objects
     # go through the manifest, convert all blobs/trees we don't have
@@ -335,10 +741,9 @@ class GitHandler(object):
         if 'encoding' in extra:
             commit.encoding = extra['encoding']
 
-        tree_sha = commit_tree(self.git.object_store, self.iterblobs(ctx))
-        commit.tree = tree_sha
+        commit.tree = self.export_tree(ctx)
 
-        self.git.object_store.add_object(commit)
+        self.object_store().add_object(commit)
         self.map_set(commit.id, ctx.hex())
 
         self.swap_out_encoding(oldenc)
@@ -375,9 +780,13 @@ class GitHandler(object):
         def is_octopus_part(ctx):
             return ctx.extra().get('hg-git', None) in ('octopus', 'octopus-done')
 
-        parents = []
-        if ctx.extra().get('hg-git', None) == 'octopus-done':
-            # implode octopus parents
+        if ctx.extra().get('hg-git', None) != 'octopus-done':
+            return ctx.parents()
+
+        # implode octopus parents, the chain is walked once per export
+        nodes = self._octopuscache.get(ctx.node())
+        if nodes is None:
+            parents = []
             part = ctx
             while is_octopus_part(part):
                 (p1, p2) = part.parents()
@@ -385,10 +794,9 @@ class GitHandler(object):
                 parents.append(p1)
                 part = p2
             parents.append(p2)
-        else:
-            parents = ctx.parents()
-
-        return parents
+            nodes = self._octopuscache[ctx.node()] = [p.node()
+                                                      for p in parents]
+        return [self.repo.changectx(n) for n in nodes]
 
     def get_git_message(self, ctx):
         extra = ctx.extra()
@@ -429,33 +837,190 @@ class GitHandler(object):
 
         return message
 
-    def iterblobs(self, ctx):
-        for f in ctx:
-            fctx = ctx[f]
-            blobid = self.map_git_get(hex(fctx.filenode()))
+    def export_tree(self, ctx):
+        """build the git tree for ctx and return its sha
+
+        If the first parent was exported by the same export, its tree is
+        reused and only the subtrees along the files that differ from it
+        are rebuilt. Trees of other parents are not, a tree imported from
+        git may hold gitlinks or modes an exported tree never has.
+        """
+        basetree = None
+        if self.ui.configbool('git', 'incrementaltrees', True):
+            basetree = self._exportedtrees.get(ctx.parents()[0].node())
+        if basetree is None:
+            tree_sha = commit_tree(self.object_store(), self.iterblobs(ctx))
+        else:
+            mf = ctx.manifest()
+            changes = dict.fromkeys(self.manifest_changes(ctx))
+            for f, blobid, mode in self.iterblobs(ctx, [f for f in changes
+                                                        if f in mf]):
+                changes[f] = (mode, blobid)
+            tree_sha = self.update_tree(basetree, changes)
+            if tree_sha is None:
+                # everything was removed
+                tree = Tree()
+                self.object_store().add_object(tree)
+                tree_sha = tree.id
+        self._exportedtrees[ctx.node()] = tree_sha
+        return tree_sha
+
+    def manifest_changes(self, ctx):
+        """paths added, removed or changed in ctx since its first parent
+
+        ctx.files() is not enough, a merge leaves out the files it takes
+        unchanged from the second parent.
+        """
+        mf = ctx.manifest()
+        pmf = ctx.parents()[0].manifest()
+        if hasattr(mf, 'diff'):
+            return mf.diff(pmf).keys()
+        changes = [f for f, fnode in mf.iteritems()
+                   if pmf.get(f) != fnode or pmf.flags(f) != mf.flags(f)]
+        changes.extend(f for f in pmf if f not in mf)
+        return changes
+
+    def get_git_object(self, sha):
+        """a parsed object from the git repository
+
+        Trees, commits and tags are kept in an LRU cache, blobs are
+        usually read once and would only push them out.
+        """
+        obj = self._objectcache.get(sha)
+        if obj is not None:
+            self._objectstats[0] += 1
+            return obj
+        self._objectstats[1] += 1
+        obj = self.git.get_object(sha)
+        if not isinstance(obj, Blob):
+            self._objectcache[sha] = obj
+        return obj
+
+    def tree_entry(self, treesha, path):
+        """the (mode, sha) of path below a tree, KeyError if it is missing
+
+        Each directory on the way is a parsed tree from the object cache,
+        indexed by name and shared by every commit that contains it. Only
+        the directories along path are read.
+        """
+        parts = path.split('/')
+        for part in parts[:-1]:
+            mode, treesha = self.get_git_object(treesha)[part]
+            if not stat.S_ISDIR(mode):
+                raise KeyError(path)
+        return self.get_git_object(treesha)[parts[-1]]
+
+    def debug_object_cache(self):
+        hits, misses = self._objectstats
+        if hits or misses:
+            self.ui.debug('git object cache: %d hits, %d misses\n' %
+                          (hits, misses))
+
+    def export_object(self, sha):
+        """read an object that may still be waiting in the export pack"""
+        obj = self._treecache.get(sha)
+        if obj is not None:
+            return obj
+        if self._exportstore is not None and sha in self._exportstore:
+            return self._exportstore.get_object(sha)
+        return self.git.get_object(sha)
+
+    def update_tree(self, tree_sha, changes):
+        """apply changes to a tree and return the new tree's sha
+
+        changes maps paths relative to the tree to (mode, sha), or to None
+        for removed files. Returns None if the new tree is empty.
+        """
+        tree = Tree()
+        if tree_sha is not None:
+            for entry in self.export_object(tree_sha).iteritems():
+                tree[entry.path] = (entry.mode, entry.sha)
+
+        files = {}
+        subdirs = {}
+        for path, change in changes.iteritems():
+            if '/' in path:
+                name, rest = path.split('/', 1)
+                subdirs.setdefault(name, {})[rest] = change
+            else:
+                files[path] = change
+
+        # removals first and additions last, so that a path can turn from
+        # a file into a directory and back
+        for name, change in files.iteritems():
+            if change is None and name in tree and \
+                    not stat.S_ISDIR(tree[name][0]):
+                del tree[name]
+        for name, subchanges in subdirs.iteritems():
+            base = None
+            if name in tree and stat.S_ISDIR(tree[name][0]):
+                base = tree[name][1]
+            sub_sha = self.update_tree(base, subchanges)
+            if sub_sha is not None:
+                tree[name] = (stat.S_IFDIR, sub_sha)
+            elif base is not None:
+                del tree[name]
+        for name, change in files.iteritems():
+            if change is not None:
+                tree[name] = change
+
+        if not len(tree):
+            return None
+        self.object_store().add_object(tree)
+        if len(self._treecache) >= self.maxtreecache:
+            self._treecache.clear()
+        self._treecache[tree.id] = tree
+        return tree.id
+
+    def iterblobs(self, ctx, files=None):
+        # work from the manifest, a filectx is only needed for new blobs
+        mf = ctx.manifest()
+        if files is None:
+            files = mf
+        for f in files:
+            fnode = mf[f]
+            blobid = self.map_blob_get(fnode)
 
             if not blobid:
-                blob = Blob.from_string(fctx.data())
-                self.git.object_store.add_object(blob)
-                self.map_set(blob.id, hex(fctx.filenode()))
+                blob = Blob.from_string(self.repo.file(f).read(fnode))
+                self.object_store().add_object(blob)
+                self.map_blob_set(blob.id, fnode)
                 blobid = blob.id
 
-            if 'l' in ctx.flags(f):
+            flags = mf.flags(f)
+            if 'l' in flags:
                 mode = 0120000
-            elif 'x' in ctx.flags(f):
+            elif 'x' in flags:
                 mode = 0100755
             else:
                 mode = 0100644
 
             yield f, blobid, mode
 
+    def map_blob_get(self, fnode):
+        """the git blob of a binary filenode, if it has been exported"""
+        blobid = self._blobcache.get(fnode)
+        if blobid is None:
+            blobid = self.map_git_get(hex(fnode))
+            if blobid is not None:
+                self._blobcache[fnode] = blobid
+        return blobid
+
+    def map_blob_set(self, blobid, fnode):
+        self.map_set(blobid, hex(fnode))
+        self._blobcache[fnode] = blobid
+
     def getnewgitcommits(self, refs=None):
+        """list the unconverted commits reachable from refs
+
+        Only shas are kept, in topological order, so that a huge fetch
+        does not hold every parsed commit in memory.
+        """
         self.init_if_missing()
 
         # import heads and fetched tags as remote references
         todo = []
         done = set()
-        convert_list = {}
 
         # get a list of all the head shas
         seenheads = set()
@@ -466,57 +1031,141 @@ class GitHandler(object):
                 # refs contains all the refs in the server, not just the ones
                 # we are pulling
                 if sha in self.git.object_store:
-                    obj = self.git.get_object(sha)
+                    obj = self.get_git_object(sha)
                     while isinstance(obj, Tag):
                         obj_type, sha = obj.object
-                        obj = self.git.get_object(sha)
+                        obj = self.get_git_object(sha)
                     if isinstance (obj, Commit) and sha not in seenheads:
                         seenheads.add(sha)
-                        todo.append(sha)
+                        self.add_commit_info(obj)
+                        # heads we already have need no traversal
+                        if not self.map_hg_get(sha):
+                            todo.append(sha)
 
         # sort by commit date
-        def commitdate(sha):
-            obj = self.git.get_object(sha)
-            return obj.commit_time-obj.commit_timezone
-
-        todo.sort(key=commitdate, reverse=True)
+        todo.sort(key=self.commit_date, reverse=True)
 
-        # traverse the heads getting a list of all the unique commits
+        # traverse the heads getting a list of all the unique commits,
+        # stopping at commits that were converted before. Their ancestors
+        # have all been converted too.
         commits = []
-        seen = set(todo)
+        # parents of the commits on the todo stack, so that a commit is
+        # parsed once however often the walk comes back to it
+        pending = {}
         while todo:
             sha = todo[-1]
             if sha in done:
                 todo.pop()
                 continue
             assert isinstance(sha, str)
-            obj = self.git.get_object(sha)
-            assert isinstance(obj, Commit)
-            for p in obj.parents:
-                if p not in done:
-                    todo.append(p)
-                    break
+            parents = pending.get(sha)
+            if parents is None:
+                parents = pending[sha] = self.commit_parents(sha, cache=False)
+            for p in parents:
+                if p in done:
+                    continue
+                if self.map_hg_get(p):
+                    done.add(p)
+                    continue
+                todo.append(p)
+                break
             else:
                 commits.append(sha)
-                convert_list[sha] = obj
                 done.add(sha)
+                pending.pop(sha, None)
                 todo.pop()
 
-        return convert_list, [commit for commit in commits if not commit in self._map_git]
+        return commits
+
+    def add_commit_info(self, commit):
+        self._commitinfo[commit.id] = (tuple(self.git_parents(commit)),
+                                       commit.commit_time -
+                                       commit.commit_timezone)
+
+    def git_parents(self, commit):
+        """parents of a git commit, none for the roots of a shallow fetch
+
+        The roots are grafted onto nothing, like git does. Once imported
+        they stay root changesets, even if a later fetch deepens them.
+        """
+        if commit.id in self.shallow:
+            return []
+        return commit.parents
+
+    def commit_info(self, sha, cache=True):
+        """(parents, commit date) of a git commit
+
+        Commits in the commit graph are not parsed. Others are parsed
+        once per handler, or every time if cache is false.
+        """
+        info = self._commitinfo.get(sha)
+        if info is None:
+            graphinfo = self.commitgraph.info(sha)
+            if graphinfo is not None:
+                info = graphinfo[:2]
+            else:
+                commit = self.git.get_object(sha)
+                assert isinstance(commit, Commit)
+                info = (tuple(self.git_parents(commit)),
+                        commit.commit_time - commit.commit_timezone)
+            if cache:
+                self._commitinfo[sha] = info
+        return info
+
+    def commit_parents(self, sha, cache=True):
+        return self.commit_info(sha, cache)[0]
+
+    def commit_date(self, sha):
+        return self.commit_info(sha)[1]
+
+    def import_git_batch(self, remote_name=None, refs=None):
+        """import git commits inside a single hg transaction
+
+        On failure the transaction is rolled back and the map entries of
+        the imported commits are forgotten. Tags, bookmarks and the map
+        are only written by the caller once the batch has been committed.
+        """
+        if not self.ui.configbool('git', 'batchimport', True):
+            return self.import_git_objects(remote_name, refs)
+
+        lock = self.repo.lock()
+        try:
+            try:
+                tr = self.repo.transaction('hg-git')
+                try:
+                    self.import_git_objects(remote_name, refs)
+                    tr.close()
+                finally:
+                    # rolls back unless the transaction was closed
+                    tr.release()
+            except:
+                # forget everything that refers to the discarded changesets
+                self.forget_map()
+                self.repo.invalidate()
+                raise
+        finally:
+            lock.release()
 
     def import_git_objects(self, remote_name=None, refs=None):
-        convert_list, commits = self.getnewgitcommits(refs)
+        commits = self.getnewgitcommits(refs)
         # import each of the commits, oldest first
         total = len(commits)
         if total:
             self.ui.status(_("importing git objects into hg\n"))
 
-        for i, csha in enumerate(commits):
+        # a thread diffs trees and reads blobs for the next commits while
+        # this one is committed
+        readahead = self.ui.configint('git', 'importreadahead', 50)
+        pending = util.readahead(self.read_git_commits(commits), readahead)
+        for i, (commit, files, blobs) in enumerate(pending):
             util.progress(self.ui, 'importing', i, total=total, unit='commits')
-            commit = convert_list[csha]
-            self.import_git_commit(commit)
+            self.import_git_commit(commit, files, blobs)
         util.progress(self.ui, 'importing', None, total=total, unit='commits')
 
+        # read_git_commits added the new commits to the graph
+        self.commitgraph.write()
+        self.debug_object_cache()
+
         # Remove any dangling tag references.
         for name, rev in self.repo.tags().items():
             if not rev in self.repo:
@@ -531,14 +1180,69 @@ class GitHandler(object):
                 if name in self.repo._tagtypes:
                     del self.repo._tagtypes[name]
 
-    def import_git_commit(self, commit):
+    def read_git_commits(self, commits):
+        """yield (commit, files changed, blob contents) for each commit
+
+        Everything import_git_commit needs from the git object store is
+        read here, so that it can run ahead in another thread. Only one
+        thread does this, dulwich's pack files are not safe to share.
+        Commits are parsed just before they are needed, and are added to
+        the commit graph on the way.
+        """
+        for csha in commits:
+            commit = self.git.get_object(csha)
+            def getobject(sha):
+                if sha == csha:
+                    return commit
+                return self.git.get_object(sha)
+            self.commitgraph.extend([csha], getobject, self.shallow)
+            files = self.get_files_changed(commit)
+            blobs = {}
+            for delete, mode, sha in files.itervalues():
+                if not delete:
+                    blobs[sha] = self.git[sha].data
+            yield commit, files, blobs
+
+    def divergent_files(self, p1, p2):
+        """paths present in both changesets at different file revisions
+
+        Git trees cannot answer this, identical contents reached in
+        different ways share a blob but not a filelog revision, so the
+        manifests are compared. Parsed manifests and the results are kept
+        for the next merges, which usually share a parent.
+        """
+        mfnode1 = self.repo.changectx(p1).manifestnode()
+        mfnode2 = self.repo.changectx(p2).manifestnode()
+        if mfnode1 == mfnode2:
+            return []
+        key = (mfnode1, mfnode2)
+        paths = self._divergentcache.get(key)
+        if paths is None:
+            manifest1 = self.read_manifest(mfnode1)
+            manifest2 = self.read_manifest(mfnode2)
+            paths = [path for path, node1 in manifest1.iteritems()
+                     if manifest2.get(path, node1) != node1]
+            self._divergentcache[key] = paths
+        return paths
+
+    def read_manifest(self, mfnode):
+        manifest = self._manifestcache.get(mfnode)
+        if manifest is None:
+            manifest = self.repo.manifest.read(mfnode)
+            self._manifestcache[mfnode] = manifest
+        return manifest
+
+    def import_git_commit(self, commit, files=None, blobs=None):
         self.ui.debug(_("importing: %s\n") % commit.id)
 
         (strip_message, hg_renames,
          hg_branch, extra) = self.extract_hg_metadata(commit.message)
 
         # get a list of the changed, added, removed files
-        files = self.get_files_changed(commit)
+        if files is None:
+            files = self.get_files_changed(commit)
+        if blobs is None:
+            blobs = {}
 
         date = (commit.author_time, -commit.author_timezone)
         text = strip_message
@@ -587,10 +1291,13 @@ class GitHandler(object):
             # begin with).
             if p2 == nullid:
                 return []
-            manifest1 = self.repo.changectx(p1).manifest()
-            manifest2 = self.repo.changectx(p2).manifest()
-            return [path for path, node1 in manifest1.iteritems()
-                    if path not in files and manifest2.get(path, node1) != node1]
+            key = (p1, p2)
+            if key not in converged:
+                converged[key] = [path for path in self.divergent_files(p1, p2)
+                                  if path not in files]
+            return converged[key]
+        converged = {}
+        changed = list(files)
 
         def getfilectx(repo, memctx, f):
             info = files.get(f)
@@ -600,19 +1307,25 @@ class GitHandler(object):
                 if delete:
                     raise IOError
 
-                data = self.git[sha].data
+                data = blobs.get(sha)
+                if data is None:
+                    data = self.get_git_object(sha).data
                 copied_path = hg_renames.get(f)
                 e = self.convert_git_int_mode(mode)
             else:
-                # it's a converged file
-                fc = context.filectx(self.repo, f, changeid=memctx.p1().rev())
+                # it's a converged file, take it from the cached manifest
+                # instead of parsing the parent's manifest for every file
+                p1ctx = memctx.p1()
+                manifest = self.read_manifest(p1ctx.manifestnode())
+                fc = context.filectx(self.repo, f, changeid=p1ctx.rev(),
+                                     fileid=manifest[f])
                 data = fc.data()
-                e = fc.flags()
+                e = manifest.flags(f)
                 copied_path = fc.renamed()
 
             return context.memfilectx(f, data, 'l' in e, 'x' in e, copied_path)
 
-        gparents = map(self.map_hg_get, commit.parents)
+        gparents = map(self.map_hg_get, self.git_parents(commit))
         p1, p2 = (nullid, nullid)
         octopus = False
 
@@ -620,7 +1333,7 @@ class GitHandler(object):
             # merge, possibly octopus
             def commit_octopus(p1, p2):
                 ctx = context.memctx(self.repo, (p1, p2), text,
-                                     list(files) + findconvergedfiles(p1, p2),
+                                     changed + findconvergedfiles(p1, p2),
                                      getfilectx, author, date, {'hg-git': 'octopus'})
                 return hex(self.repo.commitctx(ctx))
 
@@ -671,7 +1384,7 @@ class GitHandler(object):
             raise hgutil.Abort(_('you appear to have run strip - '
                                  'please run hg git-cleanup'))
         ctx = context.memctx(self.repo, (p1, p2), text,
-                             list(files) + findconvergedfiles(p1, p2),
+                             changed + findconvergedfiles(p1, p2),
                              getfilectx, author, date, extra)
 
         node = self.repo.commitctx(ctx)
@@ -693,6 +1406,18 @@ class GitHandler(object):
         genpack = self.git.object_store.generate_pack_contents
         try:
             self.ui.status(_("creating and sending data\n"))
+            conn = None
+            if self.ui.configbool('git', 'thinpush', True):
+                conn = sendpack.connect(remote, client, path)
+            if conn is not None:
+                workers = self.ui.configint('git', 'exportworkers',
+                                            defaultworkers())
+                try:
+                    return sendpack.send_pack(conn, self.git.object_store,
+                                              changed, workers,
+                                              self.maxdeltadepth)
+                finally:
+                    conn.close()
             changed_refs = client.send_pack(path, changed, genpack)
             return changed_refs
         except (HangupException, GitProtocolError), e:
@@ -760,7 +1485,7 @@ class GitHandler(object):
 
                 if ref not in refs:
                     new_refs[ref] = self.map_git_get(ctx.hex())
-                elif new_refs[ref] in self._map_git:
+                elif self.map_hg_get(new_refs[ref]):
                     rctx = self.repo[self.map_hg_get(new_refs[ref])]
                     if rctx.ancestor(ctx) == rctx or force:
                         new_refs[ref] = self.map_git_get(ctx.hex())
@@ -777,9 +1502,62 @@ class GitHandler(object):
         return new_refs
 
 
-    def fetch_pack(self, remote_name, heads):
-        client, path = self.get_transport_and_path(remote_name)
-        graphwalker = self.git.get_graph_walker()
+    def v2session(self, uri):
+        """a protocol version 2 session for uri, or None to use version 0
+
+        Version 2 is tried for git:// URLs and local repositories unless
+        git.protocol is set below 2.
+        """
+        if self.ui.configint('git', 'protocol', 2) < 2:
+            return None
+        try:
+            return protocolv2.connect(uri)
+        except (OSError, socket.error), e:
+            self.ui.debug('protocol version 2 unavailable: %s\n' % e)
+            return None
+
+    def ref_prefixes(self, heads):
+        """ref prefixes to ask a version 2 server for"""
+        if heads:
+            return ['refs/heads/' + h for h in heads] + \
+                   ['refs/tags/' + h for h in heads]
+        patterns = self.ui.configlist('git', 'fetchrefs')
+        if patterns:
+            return [re.split('[*?[]', p, 1)[0] for p in patterns]
+        return ['refs/heads/', 'refs/tags/']
+
+    def fetch_pack(self, remote_name, heads, transport=None, quiet=False,
+                   local=None):
+        """fetch heads, or all refs, from a remote into the git repository
+
+        local is the Repo to negotiate from, by default self.git. The
+        fetched pack is always added to self.git.
+        """
+        if transport is None:
+            transport = self.get_transport_and_path(remote_name)
+        client, path = transport
+        if local is None:
+            local = self.git
+        depth = self.ui.configint('git', 'depth', 0)
+        since = self.ui.configint('git', 'shallowsince', 0)
+        session = None
+        if remote_name is not None:
+            session = self.v2session(remote_name)
+        if (session is not None and (depth or since or self.shallow) and
+            not session.supports('fetch', 'shallow')):
+            session.close()
+            session = None
+        kwargs = {}
+        if session is None and since:
+            raise hgutil.Abort(_('--shallow-since needs a git server '
+                                 'speaking protocol version 2'))
+        if session is None and depth:
+            # dulwich's client can deepen since 0.19
+            if not getattr(self.git, 'update_shallow', None):
+                raise hgutil.Abort(_('--depth needs a git server speaking '
+                                     'protocol version 2'))
+            kwargs['depth'] = depth
+        graphwalker = self.graph_walker(local)
         def determine_wants(refs):
             if heads:
                 want = []
@@ -797,23 +1575,80 @@ class GitHandler(object):
                     else:
                         raise hgutil.Abort("ambiguous reference %s: %r" % (h, r))
             else:
-                want = [sha for ref, sha in refs.iteritems()
+                want = [sha for ref, sha in self.filter_refs(refs).iteritems()
                         if not ref.endswith('^{}')
                         and ( ref.startswith('refs/heads/') or ref.startswith('refs/tags/') ) ]
-            want = [x for x in want if x not in self.git]
+            self._packlock.acquire()
+            try:
+                want = [x for x in want if x not in local]
+            finally:
+                self._packlock.release()
             return want
-        f, commit = self.git.object_store.add_pack()
+        # dulwich 0.9.9 and later also return an abort function
+        f, commit = self.git.object_store.add_pack()[:2]
         try:
             try:
-                progress = GitProgress(self.ui)
-                ret = client.fetch_pack(path, determine_wants, graphwalker,
-                                        f.write, progress.progress)
-                progress.flush()
+                progress = None
+                if not quiet:
+                    progress = GitProgress(self.ui)
+                new_shallow = new_unshallow = None
+                if session is not None:
+                    ret = session.ls_refs(self.ref_prefixes(heads))
+                    wants = determine_wants(ret)
+                    if wants:
+                        new_shallow, new_unshallow = session.fetch(
+                            wants, graphwalker, f.write,
+                            progress and progress.progress,
+                            self.shallow, depth, since)
+                else:
+                    ret = client.fetch_pack(path, determine_wants,
+                                            graphwalker, f.write,
+                                            progress and progress.progress,
+                                            **kwargs)
+                    new_shallow = getattr(ret, 'new_shallow', None)
+                    new_unshallow = getattr(ret, 'new_unshallow', None)
+                if progress:
+                    progress.flush()
+                if new_shallow or new_unshallow:
+                    self._packlock.acquire()
+                    try:
+                        self.update_shallow(new_shallow, new_unshallow)
+                    finally:
+                        self._packlock.release()
+                if not heads:
+                    # leave out the refs whose objects were not fetched
+                    ret = self.filter_refs(ret)
                 return ret
             except (HangupException, GitProtocolError), e:
                 raise hgutil.Abort(_("git remote error: ") + str(e))
         finally:
-            commit()
+            if session is not None:
+                session.close()
+            # fetches running in other threads may be adding packs too
+            self._packlock.acquire()
+            try:
+                commit()
+            finally:
+                self._packlock.release()
+
+    def filter_refs(self, refs):
+        """the refs matching the git.fetchrefs patterns
+
+        Without patterns all refs are returned. Peeled tag entries are
+        kept along with their tag.
+        """
+        patterns = self.ui.configlist('git', 'fetchrefs')
+        if not patterns:
+            return refs
+        def wanted(ref):
+            if ref.endswith('^{}'):
+                ref = ref[:-3]
+            for pattern in patterns:
+                if fnmatch.fnmatchcase(ref, pattern):
+                    return True
+            return False
+        return dict((ref, sha) for ref, sha in refs.iteritems()
+                    if wanted(ref))
 
     ## REFERENCES HANDLING
 
@@ -830,8 +1665,12 @@ class GitHandler(object):
     def export_hg_tags(self):
         for tag, sha in self.repo.tags().iteritems():
             if self.repo.tagtype(tag) in ('global', 'git'):
+                git_sha = self.map_git_get(hex(sha))
+                if not git_sha:
+                    # not exported by a push of other revisions
+                    continue
                 tag = tag.replace(' ', '_')
-                self.git.refs['refs/tags/' + tag] = self.map_git_get(hex(sha))
+                self.git.refs['refs/tags/' + tag] = git_sha
                 self.tags[tag] = hex(sha)
 
     def local_heads(self):
@@ -860,14 +1699,14 @@ class GitHandler(object):
                 if ref_name[-3:] == '^{}':
                     ref_name = ref_name[:-3]
                 if not ref_name in self.repo.tags():
-                    obj = self.git.get_object(refs[k])
+                    obj = self.get_git_object(refs[k])
                     sha = None
                     if isinstance (obj, Commit): # lightweight
                         sha = self.map_hg_get(refs[k])
                         self.tags[ref_name] = sha
                     elif isinstance (obj, Tag): # annotated
                         (obj_type, obj_sha) = obj.object
-                        obj = self.git.get_object(obj_sha)
+                        obj = self.get_git_object(obj_sha)
                         if isinstance (obj, Commit):
                             sha = self.map_hg_get(obj_sha)
                             # TODO: better handling for annotated tags
@@ -977,22 +1816,16 @@ class GitHandler(object):
         return (message, renames, branch, extra)
 
     def get_file(self, commit, f):
-        otree = self.git.tree(commit.tree)
-        parts = f.split('/')
-        for part in parts:
-            (mode, sha) = otree[part]
-            obj = self.git.get_object(sha)
-            if isinstance (obj, Blob):
-                return (mode, sha, obj._text)
-            elif isinstance(obj, Tree):
-                otree = obj
+        (mode, sha) = self.tree_entry(commit.tree, f)
+        return (mode, sha, self.get_git_object(sha).data)
 
     def get_files_changed(self, commit):
         tree = commit.tree
         btree = None
 
-        if commit.parents:
-            btree = self.git[commit.parents[0]].tree
+        parents = self.git_parents(commit)
+        if parents:
+            btree = self.git[parents[0]].tree
 
         changes = self.git.object_store.tree_changes(btree, tree)
         files = {}
@@ -1090,4 +1923,6 @@ class GitHandler(object):
 
                 return transport(host, thin_packs=False, port=port), transportpath
         # if its not git or git+ssh, try a local url..
+        if uri.startswith('file://'):
+            uri = uri[len('file://'):]
         return client.SubprocessGitClient(thin_packs=False), uri
@@ -0,0 +1,286 @@
+# compact on-disk storage for the git <-> hg sha map
+#
+# The map is kept as two files of fixed-width binary records, one sorted by
+# git sha and one sorted by hg sha. Each record is the 20-byte key followed
+# by the 20-byte value. The files are mmapped on first use and searched by
+# bisection, so a lookup never has to read the whole map.
+#
+# New entries are appended to a journal of (git, hg) records instead of
+# rewriting the indexes on every save. The journal is replayed on load and
+# merged into the indexes once it grows past a threshold. Indexes are
+# replaced atomically before the journal is removed, so replaying a journal
+# left behind by an interrupted compaction is harmless, and a partially
+# written trailing record is simply dropped.
+
+import mmap
+import os
+
+from mercurial.node import bin, hex
+
+KEYSIZE = 20
+RECORDSIZE = 2 * KEYSIZE
+
+def _closefile(f):
+    # If this complains that NoneType is not callable, then
+    # atomictempfile no longer has either of rename (pre-1.9) or
+    # close (post-1.9)
+    getattr(f, 'rename', getattr(f, 'close', None))()
+
+def _mergerecords(old, new):
+    """merge two sorted iterables of (key, value) pairs, new wins on ties"""
+    old = iter(old)
+    new = iter(new)
+    o = next(old, None)
+    n = next(new, None)
+    while o is not None and n is not None:
+        if o[0] < n[0]:
+            yield o
+            o = next(old, None)
+        elif o[0] > n[0]:
+            yield n
+            n = next(new, None)
+        else:
+            yield n
+            o = next(old, None)
+            n = next(new, None)
+    while o is not None:
+        yield o
+        o = next(old, None)
+    while n is not None:
+        yield n
+        n = next(new, None)
+
+class mapindex(object):
+    """a file of (key, value) binary sha records sorted by key"""
+    def __init__(self, repo, name):
+        self.repo = repo
+        self.name = name
+        self._data = None
+        self._file = None
+
+    def exists(self):
+        return os.path.exists(self.repo.join(self.name))
+
+    def data(self):
+        if self._data is None:
+            path = self.repo.join(self.name)
+            if os.path.exists(path) and os.path.getsize(path):
+                self._file = open(path, 'rb')
+                self._data = mmap.mmap(self._file.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            else:
+                self._data = ''
+        return self._data
+
+    def close(self):
+        if self._file is not None:
+            self._data.close()
+            self._file.close()
+        self._data = None
+        self._file = None
+
+    def __len__(self):
+        return len(self.data()) // RECORDSIZE
+
+    def get(self, key):
+        data = self.data()
+        lo, hi = 0, len(data) // RECORDSIZE
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = mid * RECORDSIZE
+            k = data[offset:offset + KEYSIZE]
+            if k < key:
+                lo = mid + 1
+            elif k > key:
+                hi = mid
+            else:
+                return data[offset + KEYSIZE:offset + RECORDSIZE]
+        return None
+
+    def __iter__(self):
+        data = self.data()
+        for offset in xrange(0, len(self) * RECORDSIZE, RECORDSIZE):
+            yield (data[offset:offset + KEYSIZE],
+                   data[offset + KEYSIZE:offset + RECORDSIZE])
+
+    def write(self, records):
+        """replace the index with the given sorted (key, value) records"""
+        f = self.repo.opener(self.name, 'wb', atomictemp=True)
+        for key, value in records:
+            f.write(key + value)
+        # the old file has to be unmapped before it can be replaced
+        self.close()
+        _closefile(f)
+
+class gitmap(object):
+    """map between git and hg shas backed by two mapindex files
+
+    Lookups take and return hex shas. Entries not yet merged into the
+    on-disk indexes are kept in memory and in the journal.
+
+    Several hg shas can map to one git sha, file revisions with the same
+    contents share a blob. The hg index keeps every hg sha, the git index
+    keeps one of them for each git sha.
+    """
+    gitindex = 'git-map-git'
+    hgindex = 'git-map-hg'
+    journal = 'git-map-journal'
+
+    def __init__(self, repo, legacyfile, maxjournal=10000):
+        self.repo = repo
+        self.legacyfile = legacyfile
+        self.maxjournal = maxjournal
+        self._git = mapindex(repo, self.gitindex)
+        self._hg = mapindex(repo, self.hgindex)
+        # entries missing from the indexes, binary sha -> binary sha
+        self._newgit = {}
+        self._newhg = {}
+        # entries missing from the journal, as (git, hg) pairs
+        self._unsaved = []
+        # number of complete records in the journal
+        self._journaled = 0
+        self._migrated = False
+        if (not self._hg.exists() and
+            os.path.exists(self.repo.join(self.legacyfile))):
+            self._loadlegacy()
+        self._loadjournal()
+
+    def _loadlegacy(self):
+        # a text mapfile written by older versions: read it once, the
+        # next save() converts it to the binary indexes
+        for line in self.repo.opener(self.legacyfile):
+            gitsha, hgsha = line.strip().split(' ', 1)
+            self._add(bin(gitsha), bin(hgsha))
+        self._migrated = True
+
+    def _loadjournal(self):
+        path = self.repo.join(self.journal)
+        if not os.path.exists(path):
+            return
+        f = open(path, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        # a trailing partial record comes from an interrupted append and
+        # is overwritten by the next one
+        self._journaled = len(data) // RECORDSIZE
+        for offset in xrange(0, self._journaled * RECORDSIZE, RECORDSIZE):
+            self._add(data[offset:offset + KEYSIZE],
+                      data[offset + KEYSIZE:offset + RECORDSIZE])
+
+    def _add(self, gitsha, hgsha):
+        # pairs this one replaces are not dropped: other hg shas may still
+        # map to the same blob, and stale git records are skipped on lookup
+        self._newgit[gitsha] = hgsha
+        self._newhg[hgsha] = gitsha
+
+    def set(self, gitsha, hgsha):
+        gitsha, hgsha = bin(gitsha), bin(hgsha)
+        self._add(gitsha, hgsha)
+        self._unsaved.append((gitsha, hgsha))
+
+    def gethg(self, gitsha):
+        key = bin(gitsha)
+        value = self._newgit.get(key)
+        if value is None:
+            value = self._git.get(key)
+        # ignore entries whose hg sha a pending update remapped
+        if value is not None and self._newhg.get(value, key) == key:
+            return hex(value)
+
+    def getgit(self, hgsha):
+        key = bin(hgsha)
+        value = self._newhg.get(key)
+        if value is None:
+            # still valid if its git sha was mapped to another hg sha
+            value = self._hg.get(key)
+        if value is not None:
+            return hex(value)
+
+    def iteritems(self):
+        """iterate over (gitsha, hgsha) hex pairs, ordered by hg sha"""
+        for hgsha, gitsha in self._hgrecords():
+            yield hex(gitsha), hex(hgsha)
+
+    def _hgrecords(self):
+        # merged hg -> git records, every hg sha is kept
+        newhg = sorted(self._newhg.iteritems())
+        return _mergerecords(self._hg, newhg)
+
+    def _gitrecords(self):
+        # merged git -> hg records, dropping stale pairs
+        newgit = sorted(self._newgit.iteritems())
+        for gitsha, hgsha in _mergerecords(self._git, newgit):
+            if self._newhg.get(hgsha, gitsha) != gitsha:
+                continue
+            yield gitsha, hgsha
+
+    def dirty(self):
+        return bool(self._unsaved) or self._migrated
+
+    def save(self):
+        if not self.dirty():
+            return
+        if (self._migrated or
+            self._journaled + len(self._unsaved) >= self.maxjournal):
+            self.compact()
+        else:
+            self._appendjournal()
+
+    def _appendjournal(self):
+        path = self.repo.join(self.journal)
+        if os.path.exists(path):
+            f = open(path, 'r+b')
+            f.seek(self._journaled * RECORDSIZE)
+            f.truncate()
+        else:
+            f = self.repo.opener(self.journal, 'wb')
+        try:
+            for gitsha, hgsha in self._unsaved:
+                f.write(gitsha + hgsha)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        self._journaled += len(self._unsaved)
+        self._unsaved = []
+
+    def compact(self):
+        """merge the journal and pending entries into the indexes"""
+        # both indexes are already sorted, so this is a linear merge
+        self._hg.write(self._hgrecords())
+        self._git.write(self._gitrecords())
+        self._saved()
+
+    def rewrite(self, pairs):
+        """replace the whole map with the given (gitsha, hgsha) hex pairs"""
+        hgrecords = sorted((bin(h), bin(g)) for g, h in pairs)
+        # one hg sha for each git sha
+        gitrecords = sorted(dict((g, h) for h, g in hgrecords).iteritems())
+        self._hg.write(hgrecords)
+        self._git.write(gitrecords)
+        self._saved()
+
+    def _saved(self):
+        self._newgit = {}
+        self._newhg = {}
+        self._unsaved = []
+        self._journaled = 0
+        if os.path.exists(self.repo.join(self.journal)):
+            os.unlink(self.repo.join(self.journal))
+        if self._migrated:
+            os.unlink(self.repo.join(self.legacyfile))
+            self._migrated = False
+
+    def close(self):
+        self._git.close()
+        self._hg.close()
+
+    @classmethod
+    def filenames(cls, legacyfile):
+        """the files a map with the given legacy file is stored in"""
+        return [cls.gitindex, cls.hgindex, cls.journal, legacyfile]
+
+    def files(self):
+        return self.filenames(self.legacyfile)
@@ -8,9 +8,19 @@ from gitrepo import gitrepo
 
 def generate_repo_subclass(baseclass):
     class hgrepo(baseclass):
+        @property
+        def githandler(self):
+            """the GitHandler shared by every git operation on this repo"""
+            git = self.__dict__.get('_githandler')
+            if git is None:
+                git = self._githandler = GitHandler(self, self.ui)
+            else:
+                git.refresh()
+            return git
+
         def pull(self, remote, heads=None, force=False):
             if isinstance(remote, gitrepo):
-                git = GitHandler(self, self.ui)
+                git = self.githandler
                 return git.fetch(remote.path, heads)
             else: #pragma: no cover
                 return super(hgrepo, self).pull(remote, heads, force)
@@ -18,7 +28,7 @@ def generate_repo_subclass(baseclass):
         # TODO figure out something useful to do with the newbranch param
         def push(self, remote, force=False, revs=None, newbranch=None):
             if isinstance(remote, gitrepo):
-                git = GitHandler(self, self.ui)
+                git = self.githandler
                 git.push(remote.path, revs, force)
             else: #pragma: no cover
                 # newbranch was added in 1.6
@@ -30,7 +40,7 @@ def generate_repo_subclass(baseclass):
 
         def findoutgoing(self, remote, base=None, heads=None, force=False):
             if isinstance(remote, gitrepo):
-                git = GitHandler(self, self.ui)
+                git = self.githandler
                 base, heads = git.get_refs(remote.path)
                 out, h = super(hgrepo, self).findoutgoing(remote, base, heads, force)
                 return out
@@ -40,7 +50,7 @@ def generate_repo_subclass(baseclass):
         def _findtags(self):
             (tags, tagtypes) = super(hgrepo, self)._findtags()
 
-            git = GitHandler(self, self.ui)
+            git = self.githandler
             for tag, rev in git.tags.iteritems():
                 tags[tag] = bin(rev)
                 tagtypes[tag] = 'git'
@@ -64,7 +74,7 @@ def generate_repo_subclass(baseclass):
                 # Mercurial 1.5 and later.
                 return self._tags
 
-            git = GitHandler(self, self.ui)
+            git = self.githandler
             tagscache = super(hgrepo, self).tags()
             tagscache.update(self.gitrefs())
             for tag, rev in git.tags.iteritems():
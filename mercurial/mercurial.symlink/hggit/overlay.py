@@ -4,13 +4,15 @@
 #
 # incomplete, implemented on demand
 
+import stat
+
 from mercurial import context
 from mercurial.node import bin, hex, nullid
 
 class overlaymanifest(object):
     def __init__(self, repo, sha):
         self.repo = repo
-        self.tree = repo.handler.git.get_object(sha)
+        self.tree = repo.handler.get_git_object(sha)
         self._map = None
         self._flagmap = None
 
@@ -43,9 +45,9 @@ class overlaymanifest(object):
 
         def addtree(tree, dirname):
             for entry in tree.iteritems():
-                if entry.mode & 040000:
+                if stat.S_ISDIR(entry.mode):
                     # expand directory
-                    subtree = self.repo.handler.git.get_object(entry.sha)
+                    subtree = self.repo.handler.get_git_object(entry.sha)
                     addtree(subtree, dirname + entry.path + '/')
                 else:
                     path = dirname + entry.path
@@ -85,13 +87,13 @@ class overlayfilectx(object):
         return self.fileid
 
     def data(self):
-        blob = self.repo.handler.git.get_object(self.fileid)
+        blob = self.repo.handler.get_git_object(self.fileid)
         return blob.data
 
 class overlaychangectx(context.changectx):
     def __init__(self, repo, sha):
         self.repo = repo
-        self.commit = repo.handler.git.get_object(sha)
+        self.commit = repo.handler.get_git_object(sha)
 
     def node(self):
         return bin(self.commit.id)
@@ -156,7 +158,7 @@ class overlayrevlog(object):
         if not gitrev:
             # we've reached a revision we have
             return self.base.parents(n)
-        commit = self.repo.handler.git.get_object(n)
+        parents = self.repo.handler.commit_parents(hex(n))
 
         def gitorhg(n):
             hn = self.repo.handler.map_hg_get(hex(n))
@@ -165,9 +167,9 @@ class overlayrevlog(object):
             return n
 
         # currently ignores the octopus
-        p1 = gitorhg(bin(commit.parents[0]))
-        if len(commit.parents) > 1:
-            p2 = gitorhg(bin(commit.parents[1]))
+        p1 = gitorhg(bin(parents[0]))
+        if len(parents) > 1:
+            p2 = gitorhg(bin(parents[1]))
         else:
             p2 = nullid
 
@@ -0,0 +1,128 @@
+# write exported git objects into a single new pack
+#
+# The object count in a pack header has to be known before the first
+# object, so entries are spooled to a temporary file and copied into the
+# pack behind the header once the export is finished. The object store
+# builds the index when the pack is moved in.
+
+import hashlib
+import struct
+import tempfile
+import zlib
+
+from dulwich.objects import Blob, Commit, Tag, Tree
+
+OFS_DELTA = 6
+
+_typenums = {
+    Commit.type_name: 1,
+    Tree.type_name: 2,
+    Blob.type_name: 3,
+    Tag.type_name: 4,
+    }
+
+_typeclasses = {
+    1: Commit,
+    2: Tree,
+    3: Blob,
+    4: Tag,
+    }
+
+def _entryheader(typenum, size):
+    c = (typenum << 4) | (size & 0x0f)
+    size >>= 4
+    header = []
+    while size:
+        header.append(chr(c | 0x80))
+        c = size & 0x7f
+        size >>= 7
+    header.append(chr(c))
+    return ''.join(header)
+
+def _ofsdelta(offset):
+    ret = [chr(offset & 0x7f)]
+    offset >>= 7
+    while offset:
+        offset -= 1
+        ret.insert(0, chr(0x80 | (offset & 0x7f)))
+        offset >>= 7
+    return ''.join(ret)
+
+class packwriter(object):
+    """collect new objects for an object store into one pack
+
+    Objects are only visible in the object store after close(), until
+    then get_object() reads back the ones that were not deltified.
+    """
+    def __init__(self, object_store):
+        self.object_store = object_store
+        self._body = tempfile.TemporaryFile()
+        self._offset = 12
+        # sha -> offset of every object written to this pack
+        self.offsets = {}
+        # sha -> (type number, header length, entry length)
+        self._entries = {}
+
+    def __contains__(self, sha):
+        return sha in self.offsets
+
+    def _write(self, sha, typenum, size, zdata, extra=''):
+        self.offsets[sha] = self._offset
+        header = _entryheader(typenum, size) + extra
+        self._entries[sha] = (typenum, len(header), len(header) + len(zdata))
+        self._body.write(header + zdata)
+        self._offset += len(header) + len(zdata)
+
+    def get_object(self, sha):
+        typenum, headerlen, length = self._entries[sha]
+        if typenum == OFS_DELTA:
+            raise KeyError(sha)
+        # offsets count the pack header, which is not in the spool file
+        self._body.seek(self.offsets[sha] - 12 + headerlen)
+        zdata = self._body.read(length - headerlen)
+        self._body.seek(0, 2)
+        return _typeclasses[typenum].from_string(zlib.decompress(zdata))
+
+    def add_object(self, obj):
+        if obj.id in self.offsets or obj.id in self.object_store:
+            return
+        data = obj.as_raw_string()
+        self._write(obj.id, _typenums[obj.type_name], len(data),
+                    zlib.compress(data))
+
+    def add_blob(self, sha, size, zdata, basesha=None):
+        """add a blob that was already deflated, possibly as a delta
+
+        If basesha is given, zdata is the deflated delta against that
+        blob, which must already be in this pack, and size is the size
+        of the delta.
+        """
+        if sha in self.offsets:
+            return
+        if basesha is None:
+            self._write(sha, _typenums[Blob.type_name], size, zdata)
+        else:
+            offset = self._offset - self.offsets[basesha]
+            self._write(sha, OFS_DELTA, size, zdata, _ofsdelta(offset))
+
+    def close(self):
+        """move the pack into the object store"""
+        # dulwich 0.9.9 and later also return an abort function
+        f, commit = self.object_store.add_pack()[:2]
+        try:
+            if self.offsets:
+                sha = hashlib.sha1()
+                header = 'PACK' + struct.pack('>LL', 2, len(self.offsets))
+                f.write(header)
+                sha.update(header)
+                self._body.seek(0)
+                while True:
+                    chunk = self._body.read(1 << 20)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    sha.update(chunk)
+                f.write(sha.digest())
+        finally:
+            self._body.close()
+            commit()
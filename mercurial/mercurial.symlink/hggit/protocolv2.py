@@ -0,0 +1,246 @@
+# git wire protocol version 2 for fetches
+#
+# With version 2 the server does not start by advertising every ref. The
+# client asks for the refs it cares about with ls-refs and ref-prefix
+# arguments, then runs fetch on the same connection. Only upload-pack
+# speaks version 2, pushes still use version 0 through dulwich.
+#
+# Shallow fetches send their boundary and the depth with the fetch
+# command, and the server answers with the new boundary in a shallow-info
+# section, so they need nothing from dulwich.
+#
+# Sessions are opened for git:// URLs and local repositories. If the
+# server answers with a version 0 advertisement, connect() returns None
+# and the caller uses the dulwich client instead.
+
+import os
+import socket
+import subprocess
+
+from dulwich.errors import GitProtocolError, HangupException
+
+DEFAULT_PORT = 9418
+# haves sent per negotiation round
+HAVEBATCH = 32
+
+# pkt-line markers, returned by readpkt instead of data
+FLUSH = object()
+DELIM = object()
+RESPONSEEND = object()
+_markers = {'0000': FLUSH, '0001': DELIM, '0002': RESPONSEEND}
+
+def pkt(data):
+    return '%04x%s' % (len(data) + 4, data)
+
+def _parseurl(uri):
+    """(host, port, path) for git:// URLs, (None, None, path) for local
+    repositories and None for anything else"""
+    if uri.startswith('git://'):
+        hostport, path = (uri[len('git://'):].split('/', 1) + [''])[:2]
+        host, port = hostport, DEFAULT_PORT
+        if ':' in hostport:
+            host, port = hostport.rsplit(':', 1)
+            port = int(port)
+        return host, port, '/' + path
+    if uri.startswith('file://'):
+        uri = uri[len('file://'):]
+    if '://' in uri or uri.startswith('git@'):
+        return None
+    return None, None, uri
+
+def open_service(uri, service, version=0):
+    """start git-<service> for the repository at uri
+
+    Returns a session, or None if uri is neither a git:// URL nor a
+    local repository.
+    """
+    parsed = _parseurl(uri)
+    if parsed is None:
+        return None
+    host, port, path = parsed
+    if host is None:
+        env = dict(os.environ)
+        if version:
+            env['GIT_PROTOCOL'] = 'version=%d' % version
+        proc = subprocess.Popen(['git', service, path], env=env,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        def close():
+            proc.stdin.close()
+            proc.stdout.close()
+            proc.wait()
+        return session(proc.stdout.read, proc.stdin.write, close)
+    sock = socket.create_connection((host, port))
+    rfile = sock.makefile('rb', -1)
+    def write(data):
+        sock.sendall(data)
+    def close():
+        rfile.close()
+        sock.close()
+    conn = session(rfile.read, write, close)
+    request = 'git-%s %s\0host=%s\0' % (service, path, host)
+    if version:
+        request += '\0version=%d\0' % version
+    conn.write(pkt(request))
+    return conn
+
+def connect(uri):
+    """open a version 2 session to the repository at uri, or None"""
+    conn = open_service(uri, 'upload-pack', 2)
+    if conn is None:
+        return None
+    try:
+        if conn.handshake():
+            return conn
+    except (HangupException, GitProtocolError, socket.error):
+        pass
+    conn.close()
+    return None
+
+class session(object):
+    """a pkt-line conversation with a git service"""
+    def __init__(self, read, write, close):
+        self.read = read
+        self.write = write
+        self._close = close
+        self.capabilities = {}
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+    def readpkt(self):
+        size = self.read(4)
+        if len(size) < 4:
+            raise HangupException()
+        marker = _markers.get(size)
+        if marker is not None:
+            return marker
+        data = self.read(int(size, 16) - 4)
+        if data.startswith('ERR '):
+            raise GitProtocolError(data[4:].rstrip('\n'))
+        return data
+
+    def readlines(self):
+        """pkt-lines of a section, up to the marker that ends it"""
+        while True:
+            line = self.readpkt()
+            if line in (FLUSH, DELIM, RESPONSEEND):
+                return
+            yield line.rstrip('\n')
+
+    def handshake(self):
+        """read the capability advertisement, false for version 0"""
+        first = self.readpkt()
+        if first is FLUSH or first.rstrip('\n') != 'version 2':
+            return False
+        for line in self.readlines():
+            key, sep, value = line.partition('=')
+            self.capabilities[key] = value
+        return 'ls-refs' in self.capabilities and 'fetch' in self.capabilities
+
+    def supports(self, command, feature):
+        """whether the server advertised feature for command"""
+        return feature in self.capabilities.get(command, '').split()
+
+    def command(self, name, args):
+        request = [pkt('command=%s\n' % name), '0001']
+        request.extend(pkt(arg + '\n') for arg in args)
+        request.append('0000')
+        self.write(''.join(request))
+
+    def ls_refs(self, prefixes):
+        """a ref -> sha dict of the refs starting with one of prefixes
+
+        Annotated tags also get a ref^{} entry for the commit they point
+        to, like in a version 0 advertisement.
+        """
+        args = ['peel'] + ['ref-prefix ' + p for p in prefixes]
+        self.command('ls-refs', args)
+        refs = {}
+        for line in self.readlines():
+            fields = line.split(' ')
+            refs[fields[1]] = fields[0]
+            for attr in fields[2:]:
+                if attr.startswith('peeled:'):
+                    refs[fields[1] + '^{}'] = attr[len('peeled:'):]
+        return refs
+
+    def fetch(self, wants, graphwalker, write_pack, progress=None,
+              shallow=(), depth=None, since=None):
+        """negotiate with the haves from graphwalker and fetch a pack
+
+        shallow is the boundary of a shallow repository. depth limits the
+        history fetched to that many commits, since to the commits made
+        after that unix time. Returns the (shallow, unshallow) commit
+        sets the server sent.
+        """
+        args = ['ofs-delta']
+        if progress is None:
+            args.append('no-progress')
+        args.extend('want ' + sha for sha in wants)
+        args.extend('shallow ' + sha for sha in sorted(shallow))
+        if depth:
+            args.append('deepen %d' % depth)
+        if since:
+            args.append('deepen-since %d' % since)
+        common = []
+        ready = False
+        while not ready:
+            haves = []
+            while len(haves) < HAVEBATCH:
+                sha = graphwalker.next()
+                if sha is None:
+                    break
+                haves.append(sha)
+            if not haves:
+                break
+            self.command('fetch', args + ['have ' + sha
+                                          for sha in common + haves])
+            for line in self.readlines():
+                if line.startswith('ACK '):
+                    sha = line[4:]
+                    graphwalker.ack(sha)
+                    common.append(sha)
+                elif line == 'ready':
+                    # the pack follows this round's acknowledgments
+                    ready = True
+        if not ready:
+            self.command('fetch', args + ['have ' + sha for sha in common] +
+                         ['done'])
+        return self._readpack(write_pack, progress)
+
+    def _readpack(self, write_pack, progress):
+        newshallow = set()
+        unshallow = set()
+        while True:
+            header = self.readpkt()
+            if header in (FLUSH, RESPONSEEND):
+                raise GitProtocolError('no packfile in fetch response')
+            if header is DELIM:
+                continue
+            header = header.rstrip('\n')
+            if header == 'packfile':
+                break
+            for line in self.readlines():
+                if header != 'shallow-info':
+                    # wanted-refs and the like are not requested
+                    continue
+                kind, sha = line.split(' ', 1)
+                if kind == 'shallow':
+                    newshallow.add(sha)
+                elif kind == 'unshallow':
+                    unshallow.add(sha)
+        while True:
+            data = self.readpkt()
+            if data in (FLUSH, RESPONSEEND):
+                return newshallow, unshallow
+            band, data = data[0], data[1:]
+            if band == '\x01':
+                write_pack(data)
+            elif band == '\x02':
+                if progress is not None:
+                    progress(data)
+            elif band == '\x03':
+                raise GitProtocolError(data.rstrip('\n'))
@@ -0,0 +1,214 @@
+# push over the receive-pack protocol with a thin, deltified pack
+#
+# dulwich's send_pack writes every object in full. Here a blob that
+# replaces an older version of the same path in a pushed commit is sent
+# as a delta against that version: against the copy earlier in the same
+# pack, or against the server's copy when the parent commit is already
+# on the server (a thin pack, which receive-pack completes). The deltas
+# are computed by a blobpool, and the pack is streamed to the server
+# batch by batch while it is generated.
+#
+# The pack header holds the number of objects, so they are listed before
+# the first byte is written. Only commits, trees and tags are kept from
+# that pass, blobs are read again when their batch is written.
+
+import hashlib
+import struct
+import zlib
+
+from dulwich import client as dulwichclient
+from dulwich.errors import GitProtocolError
+from mercurial.node import bin
+
+from blobpool import blobpool
+from packwriter import OFS_DELTA, _entryheader, _ofsdelta, _typenums
+from protocolv2 import open_service, pkt, session
+
+REF_DELTA = 7
+ZERO = '0' * 40
+# blobs deltified per pool batch
+BATCHSIZE = 200
+
+def connect(uri, client, path):
+    """start receive-pack for uri, or None for unsupported transports"""
+    if isinstance(client, dulwichclient.SSHGitClient):
+        con = dulwichclient.get_ssh_vendor().connect_ssh(
+            client.host, ["git-receive-pack '%s'" % path],
+            port=client.port, username=client.username)
+        return session(con.read, con.write, con.close)
+    return open_service(uri, 'receive-pack')
+
+def _readrefs(conn):
+    refs = {}
+    capabilities = set()
+    for line in conn.readlines():
+        if '\0' in line:
+            line, caps = line.split('\0', 1)
+            capabilities.update(caps.split())
+        sha, ref = line.split(' ', 1)
+        refs[ref] = sha
+    return refs, capabilities
+
+def _readstatus(conn):
+    lines = list(conn.readlines())
+    if not lines or lines[0] != 'unpack ok':
+        raise GitProtocolError('unpacking failed on the server: %s' %
+                               (lines and lines[0] or 'no status'))
+    failed = [line[3:] for line in lines[1:] if line.startswith('ng ')]
+    if failed:
+        raise GitProtocolError('refs not updated: %s' % ', '.join(failed))
+
+def send_pack(conn, object_store, update_refs, workers=1, maxdepth=50):
+    """update the refs on the server like dulwich's send_pack
+
+    update_refs gets the refs the server has and returns the refs it
+    should have, which are also returned.
+    """
+    old_refs, capabilities = _readrefs(conn)
+    new_refs = update_refs(dict(old_refs))
+    commands = []
+    for ref, sha in sorted(new_refs.iteritems()):
+        old = old_refs.get(ref, ZERO)
+        if not ref.endswith('^{}') and sha != old:
+            commands.append('%s %s %s' % (old, sha, ref))
+    if not commands:
+        conn.write('0000')
+        return new_refs
+
+    caps = [c for c in ('report-status', 'ofs-delta') if c in capabilities]
+    request = [pkt('%s\0%s\n' % (commands[0], ' '.join(caps)))]
+    request.extend(pkt(command + '\n') for command in commands[1:])
+    request.append('0000')
+    conn.write(''.join(request))
+
+    have = [sha for sha in old_refs.itervalues()
+            if sha != ZERO and sha in object_store]
+    want = [sha for ref, sha in new_refs.iteritems()
+            if sha != old_refs.get(ref, ZERO) and not ref.endswith('^{}')]
+    writer = _thinpack(object_store, conn.write, 'ofs-delta' in capabilities,
+                       'no-thin' not in capabilities, maxdepth)
+    writer.write(object_store.generate_pack_contents(have, want), workers)
+    if 'report-status' in capabilities:
+        _readstatus(conn)
+    return new_refs
+
+class _thinpack(object):
+    def __init__(self, object_store, write, ofsdelta, thin, maxdepth):
+        self.object_store = object_store
+        self._write = write
+        self.ofsdelta = ofsdelta
+        self.thin = thin
+        self.maxdepth = maxdepth
+        self._sha = hashlib.sha1()
+        self._offset = 0
+        self.offsets = {}
+
+    def _emit(self, data):
+        self._sha.update(data)
+        self._write(data)
+        self._offset += len(data)
+
+    def _bases(self, sending):
+        # blob sha -> the blob it replaces at the same path in the first
+        # parent, if that parent is sent too or is on the server already
+        bases = {}
+        for obj in sending.itervalues():
+            if obj is None or obj.type_name != 'commit' or not obj.parents:
+                continue
+            parent = sending.get(obj.parents[0])
+            if parent is None:
+                if not self.thin or obj.parents[0] not in self.object_store:
+                    continue
+                parent = self.object_store[obj.parents[0]]
+            for (oldpath, newpath), modes, (oldsha, newsha) in \
+                    self.object_store.tree_changes(parent.tree, obj.tree):
+                if (oldpath == newpath and oldsha != newsha and
+                    newsha in sending and newsha not in bases):
+                    bases[newsha] = oldsha
+        return bases
+
+    def _order(self, blobs, bases, sending):
+        # blobs with their in-pack bases first, as (sha, base) pairs
+        order = []
+        depth = {}
+        for sha in blobs:
+            chain = []
+            while sha not in depth and sha not in chain:
+                chain.append(sha)
+                sha = bases.get(sha)
+                if sha is None or sha not in sending:
+                    break
+            for sha in reversed(chain):
+                base = bases.get(sha)
+                if base is None:
+                    pass
+                elif base not in sending:
+                    # the server's copy
+                    if not self.thin:
+                        base = None
+                elif depth.get(base, self.maxdepth) >= self.maxdepth:
+                    # not written yet because of a revert cycle, or the
+                    # chain is long enough
+                    base = None
+                if base is None:
+                    depth[sha] = 0
+                else:
+                    depth[sha] = depth.get(base, 0) + 1
+                order.append((sha, base))
+        return order
+
+    def write(self, objects, workers=1):
+        # sha -> object to send, None for blobs
+        sending = {}
+        blobs = []
+        for obj in objects:
+            # generate_pack_contents gives (object, path) pairs
+            if isinstance(obj, tuple):
+                obj = obj[0]
+            if obj.type_name == 'blob':
+                blobs.append(obj.id)
+                sending[obj.id] = None
+            else:
+                sending[obj.id] = obj
+        self._emit('PACK' + struct.pack('>LL', 2, len(sending)))
+        for obj in sending.itervalues():
+            if obj is not None:
+                self._emitobject(obj)
+
+        order = self._order(blobs, self._bases(sending), sending)
+        pool = blobpool(workers)
+        try:
+            for start in xrange(0, len(order), BATCHSIZE):
+                batch = order[start:start + BATCHSIZE]
+                jobs = []
+                for sha, base in batch:
+                    basedata = None
+                    if base is not None:
+                        basedata = self.object_store[base].as_raw_string()
+                    jobs.append((self.object_store[sha].as_raw_string(),
+                                 basedata))
+                results = pool.pack(jobs)()
+                for (sha, base), (blobsha, isdelta, size, zdata) in \
+                        zip(batch, results):
+                    self._emitblob(sha, base if isdelta else None,
+                                   size, zdata)
+        finally:
+            pool.close()
+        self._write(self._sha.digest())
+
+    def _emitobject(self, obj):
+        data = obj.as_raw_string()
+        self.offsets[obj.id] = self._offset
+        self._emit(_entryheader(_typenums[obj.type_name], len(data)) +
+                   zlib.compress(data))
+
+    def _emitblob(self, sha, base, size, zdata):
+        self.offsets[sha] = self._offset
+        if base is None:
+            header = _entryheader(_typenums['blob'], size)
+        elif self.ofsdelta and base in self.offsets:
+            header = (_entryheader(OFS_DELTA, size) +
+                      _ofsdelta(self._offset - self.offsets[base]))
+        else:
+            header = _entryheader(REF_DELTA, size) + bin(base)
+        self._emit(header + zdata)
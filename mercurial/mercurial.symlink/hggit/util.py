@@ -1,5 +1,155 @@
-"""Compatability functions for old Mercurial versions."""
+"""Compatability functions for old Mercurial versions, and small helpers."""
+
+import Queue
+import sys
+import threading
 
 def progress(ui, *args, **kwargs):
     """Shim for progress on hg < 1.4. Remove when 1.3 is dropped."""
     getattr(ui, 'progress', lambda *x, **kw: None)(*args, **kwargs)
+
+class lrucache(object):
+    """a mapping that keeps only the maxsize most recently used entries"""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        # key -> [prev, next, key, value], in a circular list around root
+        self._cache = {}
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _append(self, link):
+        root = self._root
+        last = root[0]
+        link[0], link[1] = last, root
+        last[1] = root[0] = link
+
+    def get(self, key, default=None):
+        link = self._cache.get(key)
+        if link is None:
+            return default
+        self._unlink(link)
+        self._append(link)
+        return link[3]
+
+    def __setitem__(self, key, value):
+        link = self._cache.get(key)
+        if link is not None:
+            link[3] = value
+            self._unlink(link)
+            self._append(link)
+            return
+        if len(self._cache) >= self.maxsize:
+            oldest = self._root[1]
+            self._unlink(oldest)
+            del self._cache[oldest[2]]
+        link = [None, None, key, value]
+        self._append(link)
+        self._cache[key] = link
+
+    def clear(self):
+        self._cache.clear()
+        self._root[:] = [self._root, self._root, None, None]
+
+def readahead(items, size):
+    """iterate over items while a thread computes up to size more of them
+
+    Exceptions raised while producing an item are re-raised to the
+    caller. With a size below 1 the items are produced in the caller's
+    thread.
+    """
+    if size < 1:
+        for item in items:
+            yield item
+        return
+
+    queue = Queue.Queue(size)
+    stop = threading.Event()
+    done = object()
+
+    def put(entry):
+        while not stop.isSet():
+            try:
+                queue.put(entry, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((None, item)):
+                    return
+            put((None, done))
+        except:
+            put((sys.exc_info(), None))
+
+    thread = threading.Thread(target=produce)
+    thread.setDaemon(True)
+    thread.start()
+    try:
+        while True:
+            # poll so that the caller can still be interrupted
+            try:
+                exc, item = queue.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            if exc is not None:
+                raise exc[0], exc[1], exc[2]
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        while thread.isAlive():
+            thread.join(0.1)
+
+def threadmap(func, items, workers):
+    """call func on every item using up to workers threads
+
+    Returns a (result, exc_info) pair for each item, in the order of
+    items. exc_info is None unless func raised.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    todo = Queue.Queue()
+    for entry in enumerate(items):
+        todo.put(entry)
+    finished = Queue.Queue()
+
+    def work():
+        while True:
+            try:
+                i, item = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                finished.put((i, (func(item), None)))
+            except:
+                finished.put((i, (None, sys.exc_info())))
+
+    for n in xrange(max(1, min(workers, len(items)))):
+        thread = threading.Thread(target=work)
+        thread.setDaemon(True)
+        thread.start()
+    for n in xrange(len(items)):
+        # poll so that the caller can still be interrupted
+        while True:
+            try:
+                i, result = finished.get(timeout=0.1)
+                break
+            except Queue.Empty:
+                pass
+        results[i] = result
+    return results